@@ -53,30 +53,33 @@ class CropDusterImageFieldFile(ImageFieldFile):
             return self.field.db_field.sizes
 
     def _get_new_crop_thumb(self, size):
+        return self._get_new_crop_thumbs([size])[0]
+
+    def _get_new_crop_thumbs(self, sizes):
         # "Imports"
         Image = compat_rel_to(self.field.db_field)
         Thumb = compat_rel_to(Image._meta.get_field("thumbs"))
 
         box = Box(0, 0, self.width, self.height)
-        crop_box = Crop(box, self.path)
-
-        best_fit = size.fit_to_crop(crop_box, original_image=self.path)
-        fit_box = best_fit.box
-        crop_thumb = Thumb(**{
-            "name": size.name,
-            "width": fit_box.w,
-            "height": fit_box.h,
-            "crop_x": fit_box.x1,
-            "crop_y": fit_box.y1,
-            "crop_w": fit_box.w,
-            "crop_h": fit_box.h,
-        })
-        return crop_thumb
+        crop_box = Crop(box, (self.width, self.height))
+
+        crop_thumbs = []
+        for size, best_fit in zip(sizes, crop_box.best_fit_many(sizes)):
+            fit_box = best_fit.box
+            crop_thumbs.append(Thumb(**{
+                "name": size.name,
+                "width": fit_box.w,
+                "height": fit_box.h,
+                "crop_x": fit_box.x1,
+                "crop_y": fit_box.y1,
+                "crop_w": fit_box.w,
+                "crop_h": fit_box.h,
+            }))
+        return crop_thumbs
 
     def generate_thumbs(self, permissive=False):
         # "Imports"
         Image = compat_rel_to(self.field.db_field)
-        Thumb = compat_rel_to(Image._meta.get_field("thumbs"))
 
         has_existing_image = self.related_object is not None
 
@@ -94,12 +97,21 @@ class CropDusterImageFieldFile(ImageFieldFile):
             image.save()
             self.related_object = image
 
-        for size in self.sizes:
+        sizes = self.sizes
+        crop_thumbs = {}
+        new_crop_sizes = []
+        thumbs_by_name = self.related_object.get_thumbs_by_name()
+        for size in sizes:
             try:
-                crop_thumb = self.related_object.thumbs.get(name=size.name)
-            except Thumb.DoesNotExist:
-                crop_thumb = self._get_new_crop_thumb(size)
+                crop_thumbs[size.name] = thumbs_by_name[size.name]
+            except KeyError:
+                new_crop_sizes.append(size)
 
+        for crop_thumb in self._get_new_crop_thumbs(new_crop_sizes):
+            crop_thumbs[crop_thumb.name] = crop_thumb
+
+        for size in sizes:
+            crop_thumb = crop_thumbs[size.name]
             thumbs = self.related_object.save_size(size, thumb=crop_thumb, permissive=permissive)
 
             for slug, thumb in six.iteritems(thumbs):
@@ -396,6 +408,20 @@ class ReverseForeignRelation(ManyToManyField):
     def get_internal_type(self):
         return "ManyToManyField"
 
+    def save_form_data(self, instance, data):
+        # Objects not yet attached to an instance (thumbs staged while
+        # cropping) are attached with save(), so that Thumb.save() promotes
+        # their files; the rest are left to the default bulk update
+        pks = [getattr(obj, 'pk', obj) for obj in data or []]
+        unattached = compat_rel_to(self)._default_manager.filter(**{
+            'pk__in': pks,
+            '%s__isnull' % self.field_name: True,
+        })
+        for obj in unattached:
+            setattr(obj, self.field_name, instance)
+            obj.save()
+        return super(ReverseForeignRelation, self).save_form_data(instance, data)
+
     def formfield(self, **kwargs):
         kwargs.update({
             'form_class': CropDusterThumbFormField,
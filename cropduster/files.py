@@ -6,16 +6,19 @@ import hashlib
 
 import PIL.Image
 
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
 from django.db.models.fields.files import FieldFile, FileField
 from django.utils.functional import cached_property
 from django.utils.http import urlunquote_plus
 from django.utils.six.moves.urllib import parse as urlparse
-from django.utils.six.moves.urllib.request import urlopen
 
 from generic_plus.utils import get_relative_media_url, get_media_path
 
+from cropduster.settings import CROPDUSTER_REMOTE_CACHE_TIMEOUT
+from cropduster.utils.remote import fetch_url
+
 
 class VirtualFieldFile(FieldFile):
 
@@ -42,13 +45,25 @@ class VirtualFieldFile(FieldFile):
         raise NotImplementedError
 
     @cached_property
-    def dimensions(self):
+    def image_info(self):
+        """
+        The ((width, height), format) of the image, from a single read of
+        the file's header: the image data itself is not decoded.
+        """
         try:
             pil_image = PIL.Image.open(self.path)
         except:
-            return (0, 0)
+            return ((0, 0), None)
         else:
-            return pil_image.size
+            return (pil_image.size, pil_image.format)
+
+    @cached_property
+    def dimensions(self):
+        return self.image_info[0]
+
+    @cached_property
+    def image_format(self):
+        return self.image_info[1]
 
     @cached_property
     def width(self):
@@ -105,24 +120,31 @@ class ImageFile(VirtualFieldFile):
         from cropduster.models import StandaloneImage
         from cropduster.views.forms import clean_upload_data
 
-        image_contents = urlopen(url).read()
-        md5_hash = hashlib.md5()
-        md5_hash.update(image_contents)
-        try:
-            standalone_image = StandaloneImage.objects.get(md5=md5_hash.hexdigest())
-        except StandaloneImage.DoesNotExist:
-            pass
-        else:
-            return get_relative_media_url(standalone_image.image.name)
+        # The same URL pasted again shortly after is not downloaded again
+        cache_key = 'cropduster_url_%s' % hashlib.md5(url.encode('utf-8')).hexdigest()
+        path = cache.get(cache_key)
+        if path and os.path.exists(os.path.join(settings.MEDIA_ROOT, path)):
+            return path
 
-        parse_result = urlparse.urlparse(url)
-
-        fake_upload = SimpleUploadedFile(os.path.basename(parse_result.path), image_contents)
-        file_data = clean_upload_data({
-            'image': fake_upload,
-            'upload_to': self.upload_to,
-        })
-        return get_relative_media_url(file_data['image'].name)
+        image_file, md5 = fetch_url(url)
+        try:
+            try:
+                standalone_image = StandaloneImage.objects.get_by_md5(md5)
+            except StandaloneImage.DoesNotExist:
+                parse_result = urlparse.urlparse(url)
+                file_data = clean_upload_data({
+                    'image': File(image_file, name=os.path.basename(parse_result.path)),
+                    'upload_to': self.upload_to,
+                })
+                file_data['image'].close()
+                path = get_relative_media_url(file_data['image'].name)
+            else:
+                path = get_relative_media_url(standalone_image.image.name)
+        finally:
+            image_file.close()
+
+        cache.set(cache_key, path, CROPDUSTER_REMOTE_CACHE_TIMEOUT)
+        return path
 
     def __nonzero__(self):
         """When evaluated as boolean, base on whether self._path is not None"""
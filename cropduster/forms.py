@@ -91,6 +91,8 @@ class CropDusterThumbWidget(forms.SelectMultiple):
                 'data-height': thumb.height,
                 'data-tmp-file': json.dumps(use_tmp_file),
             }
+            if thumb.format:
+                attrs['data-extension'] = thumb.extension
         option_value = force_text(option_value)
         if option_value in selected_choices:
             selected_html = u' selected="selected"'
@@ -0,0 +1,171 @@
+from __future__ import division
+
+import os
+import time
+from datetime import timedelta
+
+import PIL.Image
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cropduster.models import Image, Thumb, safe_str_path
+from cropduster.settings import CROPDUSTER_DEDUPLICATE_DIR
+from cropduster.utils.image import IMAGE_EXTENSIONS
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Deletes files left behind by cropduster: temporary (_tmp) thumbnails "
+        "and thumbnails staged in abandoned crop dialogs, _preview images, "
+        "originals in the deduplicated store which are no longer linked to, "
+        "and (with --superseded) the files of images which have been replaced.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+            help="Directories to scan, relative to MEDIA_ROOT (default: all of MEDIA_ROOT)")
+        parser.add_argument('--days', type=float, default=1,
+            help="Only delete files and records older than this many days (default: 1)")
+        parser.add_argument('--superseded', action='store_true', default=False,
+            help="Also delete images which have been replaced on their object, and their files")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help="Report what would be deleted without deleting anything")
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.verbosity = options['verbosity']
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+
+        max_age = timedelta(days=options['days'])
+        cutoff = timezone.now() - max_age
+        self.cutoff_timestamp = time.time() - max_age.total_seconds()
+
+        PIL.Image.init()
+        self.extensions = set(PIL.Image.EXTENSION) | set(IMAGE_EXTENSIONS.values())
+
+        staged_thumbs = Thumb.objects.filter(image__isnull=True, date_modified__lt=cutoff)
+        self.log(u"%d staged thumbs from abandoned crops" % staged_thumbs.count())
+        if not self.dry_run:
+            staged_thumbs.delete()
+
+        if options['superseded']:
+            self.delete_superseded_images(cutoff)
+
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        store_root = safe_str_path(os.path.join(media_root, CROPDUSTER_DEDUPLICATE_DIR))
+        roots = [os.path.join(media_root, p) for p in options['paths']] or [media_root]
+        for root in roots:
+            for dir_path, dir_names, file_names in os.walk(safe_str_path(root)):
+                in_store = (dir_path + os.sep).startswith(store_root + os.sep)
+                # Only touch files in cropduster's own upload folders
+                is_upload_dir = any(self.is_original_file(n) for n in file_names)
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    if in_store:
+                        # Each upload of a stored original is a hard link to it
+                        self.delete_file(path, max_links=1)
+                    elif is_upload_dir and self.is_temporary_file(file_name):
+                        self.delete_file(path)
+
+        self.stdout.write(u"%s %d files, %s" % (
+            "Would delete" if self.dry_run else "Deleted",
+            self.deleted_files, format_bytes(self.deleted_bytes)))
+
+    def log(self, msg):
+        if self.verbosity > 1:
+            self.stdout.write(msg)
+
+    def split_image_name(self, file_name):
+        """
+        Returns the (stem, extension) of `file_name`, or None if it does
+        not have an image extension.
+        """
+        if isinstance(file_name, bytes):
+            file_name = file_name.decode('utf-8', 'replace')
+        stem, extension = os.path.splitext(file_name)
+        if extension.lower() not in self.extensions:
+            return None
+        return stem, extension
+
+    def is_original_file(self, file_name):
+        """Whether `file_name` is the original image of an upload folder."""
+        name = self.split_image_name(file_name)
+        return name is not None and name[0] == 'original'
+
+    def is_temporary_file(self, file_name):
+        """Whether `file_name` is a _tmp thumbnail or a _preview image."""
+        name = self.split_image_name(file_name)
+        if name is None:
+            return False
+        stem = name[0]
+        return stem.endswith('_tmp') or stem == '_preview'
+
+    def delete_file(self, path, max_links=None):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if stat.st_mtime >= self.cutoff_timestamp:
+            return
+        if max_links is not None and stat.st_nlink > max_links:
+            return
+        self.log(u"Deleting %s" % path)
+        if not self.dry_run:
+            try:
+                os.unlink(path)
+            except OSError:
+                return
+        self.deleted_files += 1
+        self.deleted_bytes += stat.st_size
+
+    def delete_superseded_images(self, cutoff):
+        """
+        Delete the images which Image.save demoted to prev_object_id, and
+        their files that are not shared with any remaining image.
+        """
+        superseded = Image.objects.filter(
+            object_id__isnull=True, prev_object_id__isnull=False, date_modified__lt=cutoff)
+        for image in superseded.iterator():
+            paths = set()
+            if image.image:
+                paths.add(image.image.path)
+                for thumb in image.thumbs.all():
+                    paths.update(thumb.get_file_paths(image))
+            self.log(u"Deleting superseded image %d (%s)" % (image.pk, image.image.name))
+            if not self.dry_run:
+                image.delete()
+            if not paths:
+                continue
+            for path in paths - self.get_referenced_paths(image):
+                self.delete_file(safe_str_path(path))
+
+    def get_referenced_paths(self, image):
+        """
+        The paths of the files of all other images (and their thumbs) in
+        the directory of `image`, which must be kept.
+        """
+        dir_name = os.path.dirname(image.image.name)
+        others = (Image.objects.exclude(pk=image.pk)
+            .filter(image__startswith=dir_name + '/')
+            .prefetch_related('thumbs'))
+        paths = set()
+        for other in others:
+            if os.path.dirname(other.image.name) != dir_name:
+                continue
+            paths.add(other.image.path)
+            for thumb in other.thumbs.all():
+                paths.update(thumb.get_file_paths(other))
+        return paths
+
+
+def format_bytes(num_bytes):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024 or unit == 'GB':
+            break
+        num_bytes /= 1024
+    if unit == 'bytes':
+        return u"%d bytes" % num_bytes
+    return u"%.1f %s" % (num_bytes, unit)
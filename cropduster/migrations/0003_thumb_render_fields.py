@@ -0,0 +1,46 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0002_alt_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumb',
+            name='retina',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='widths',
+            field=models.CharField(max_length=255, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='extra_formats',
+            field=models.CharField(max_length=255, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='format',
+            field=models.CharField(max_length=10, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='profile',
+            field=models.CharField(max_length=50, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='max_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='fingerprint',
+            field=models.CharField(max_length=40, blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,60 @@
+import os
+import re
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def normalize_md5s(apps, schema_editor):
+    """
+    Rewrite every StandaloneImage.md5 as a lowercase hex digest. Older rows
+    stored the raw digest; those are rehashed from their original image.
+    Rows that cannot be hashed, and all but the first row for any hash,
+    are set to NULL so that the column can be made unique.
+    """
+    StandaloneImage = apps.get_model('cropduster', 'StandaloneImage')
+    seen = set()
+    rows = StandaloneImage.objects.order_by('pk').values_list('pk', 'md5', 'image')
+    for pk, md5, image_name in rows.iterator():
+        new_md5 = (md5 or '').strip().lower()
+        if not re.match(r'\A[0-9a-f]{32}\Z', new_md5):
+            new_md5 = hash_file(os.path.join(settings.MEDIA_ROOT, image_name or ''))
+        if new_md5 in seen:
+            new_md5 = None
+        if new_md5:
+            seen.add(new_md5)
+        if new_md5 != md5:
+            StandaloneImage.objects.filter(pk=pk).update(md5=new_md5)
+
+
+def hash_file(path):
+    md5 = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                md5.update(chunk)
+    except (IOError, OSError):
+        return None
+    return md5.hexdigest()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0003_thumb_render_fields'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='standaloneimage',
+            name='md5',
+            field=models.CharField(max_length=32, null=True, blank=True),
+        ),
+        migrations.RunPython(normalize_md5s, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='standaloneimage',
+            name='md5',
+            field=models.CharField(max_length=32, unique=True, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0004_standaloneimage_md5_unique'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='image',
+            index_together=set([('content_type', 'prev_object_id')]),
+        ),
+    ]
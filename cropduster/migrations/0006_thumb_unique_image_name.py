@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def delete_duplicate_thumbs(apps, schema_editor):
+    """
+    Keep only the newest thumb of each name on an image, pointing any
+    auto thumbs that referenced the older duplicates at it instead.
+    """
+    Thumb = apps.get_model('cropduster', 'Thumb')
+    duplicates = (Thumb.objects.filter(image__isnull=False)
+        .values('image', 'name')
+        .annotate(num_thumbs=Count('pk'), keep_pk=Max('pk'))
+        .filter(num_thumbs__gt=1))
+    for duplicate in list(duplicates):
+        stale = (Thumb.objects
+            .filter(image=duplicate['image'], name=duplicate['name'])
+            .exclude(pk=duplicate['keep_pk']))
+        stale_pks = list(stale.values_list('pk', flat=True))
+        Thumb.objects.filter(reference_thumb__in=stale_pks).update(
+            reference_thumb=duplicate['keep_pk'])
+        Thumb.objects.filter(pk__in=stale_pks).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_thumbs, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='thumb',
+            unique_together=set([('image', 'name')]),
+        ),
+    ]
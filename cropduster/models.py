@@ -1,6 +1,7 @@
 from __future__ import division
 
 import hashlib
+import json
 import random
 import os
 import time
@@ -10,7 +11,7 @@ from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.core.files.storage import FileSystemStorage
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models
+from django.db import models
 from django.utils import six
 from django.utils.six.moves import xrange
 
@@ -24,7 +25,9 @@ from .fields import (
     CropDusterSimpleImageField)
 from .files import VirtualFieldFile
 from .resizing import Size, Box, Crop
-from .utils import process_image
+from .utils import (
+    process_image, is_animated_gif, is_format_supported, get_thumb_format, get_file_md5)
+from .utils.image import IMAGE_EXTENSIONS, RENDER_VERSION
 from . import settings as cropduster_settings
 
 
@@ -57,6 +60,21 @@ class Thumb(models.Model):
     crop_w = models.PositiveIntegerField(blank=True, null=True)
     crop_h = models.PositiveIntegerField(blank=True, null=True)
 
+    # Whether a @2x version of the thumbnail was rendered along with it
+    retina = models.BooleanField(default=False)
+    # Comma-separated widths of the smaller versions rendered for srcset
+    widths = models.CharField(max_length=255, blank=True, default='')
+    # Comma-separated additional formats (e.g. 'webp') the thumb was rendered in
+    extra_formats = models.CharField(max_length=255, blank=True, default='')
+    # The format the thumb was saved in, if not that of the original image
+    format = models.CharField(max_length=10, blank=True, default='')
+    # The encoder profile the thumb was saved with, if not the default
+    profile = models.CharField(max_length=50, blank=True, default='')
+    # The byte budget the thumb was saved within, if any
+    max_bytes = models.PositiveIntegerField(blank=True, null=True)
+    # A hash of everything that went into rendering the thumb's files
+    fingerprint = models.CharField(max_length=40, blank=True, default='')
+
     date_modified = models.DateTimeField(auto_now=True)
 
     image = models.ForeignKey('Image', related_name='+', null=True, blank=True,
@@ -65,6 +83,7 @@ class Thumb(models.Model):
     class Meta:
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_thumb' % cropduster_settings.CROPDUSTER_DB_PREFIX
+        unique_together = ("image", "name")
 
     def __unicode__(self):
         return self.name
@@ -73,7 +92,7 @@ class Thumb(models.Model):
     def image_file(self):
         return Image.get_file_for_size(
             image=self.image, size_name=self.name,
-            tmp=not(getattr(self.image, 'pk', None)))
+            tmp=not(getattr(self.image, 'pk', None)), format=self.format or None)
 
     @property
     def url(self):
@@ -89,25 +108,108 @@ class Thumb(models.Model):
     def path(self):
         return self.image_file.path if self.image_file else ''
 
+    @property
+    def extension(self):
+        """The file extension of the thumb, with a dot (.) prepended to it"""
+        if self.format:
+            return IMAGE_EXTENSIONS.get(self.format.upper(), u'.%s' % self.format.lower())
+        return os.path.splitext(self.image_file.name)[1] if self.image_file else u''
+
+    @property
+    def retina_name(self):
+        return u'%s@2x' % self.name
+
+    def get_widths(self):
+        """Returns the srcset widths rendered for the thumb, largest first."""
+        return [int(w) for w in (self.widths or '').split(',') if w]
+
+    def get_width_name(self, width):
+        return u'%s_%dw' % (self.name, width)
+
+    def get_width_height(self, width):
+        return int(round(self.height * width / self.width))
+
+    def get_max_bytes(self, width, height):
+        """
+        Returns the byte budget for a rendition of the thumb at `width` x
+        `height`, scaling max_bytes by its area relative to the thumb's.
+        """
+        if not self.max_bytes:
+            return None
+        return int(round(self.max_bytes * (width * height) / (self.width * self.height)))
+
+    def get_extra_formats(self):
+        """Returns the additional formats rendered for the thumb."""
+        return [f for f in (self.extra_formats or '').split(',') if f]
+
+    @property
+    def file_names(self):
+        """The size names of all of the files rendered for the thumbnail."""
+        names = [self.name]
+        if self.retina:
+            names.append(self.retina_name)
+        names += [self.get_width_name(w) for w in self.get_widths()]
+        return names
+
+    def get_file_paths(self, image=None, tmp=False):
+        """The paths of all of the files rendered for the thumbnail."""
+        image = image or self.image
+        paths = []
+        for name in self.file_names:
+            paths.append(image.get_image_path(name, tmp=tmp, format=self.format or None))
+            paths += [image.get_image_path(name, tmp=tmp, format=f) for f in self.get_extra_formats()]
+        return paths
+
+    @property
+    def is_staged(self):
+        """
+        Whether the thumb is staged: rendered to _tmp files while cropping,
+        but not yet attached to an image by saving the parent form.
+        """
+        return not self.image_id
+
     def save(self, *args, **kwargs):
-        if self.pk:
-            qset = Thumb.objects
-            if not connection.get_autocommit():
-                qset = qset.select_for_update()
-            try:
-                orig_thumb = qset.get(pk=self.pk)
-            except Thumb.DoesNotExist:
-                pass
-            else:
-                if self.image_id and not orig_thumb.image_id:
-                    try:
-                        os.rename(
-                            self.image.get_image_path(self.name, tmp=True),
-                            self.image.get_image_path(self.name))
-                    except (IOError, OSError):
-                        pass
+        if self.pk and self.image_id:
+            # Attach a staged thumb to its image with a single conditional
+            # UPDATE, so that exactly one save promotes its files, without
+            # locking the row while they are moved into place
+            claimed = Thumb.objects.filter(pk=self.pk, image__isnull=True).update(
+                image=self.image_id)
+            if claimed:
+                try:
+                    self.promote_staged_files()
+                except:
+                    # Leave the thumb staged rather than attached without files
+                    Thumb.objects.filter(pk=self.pk).update(image=None)
+                    raise
         return super(Thumb, self).save(*args, **kwargs)
 
+    def promote_staged_files(self):
+        """
+        Move the thumb's _tmp files to their final paths, rendering the
+        thumb instead if any of them are missing (as they are for thumbs
+        cropped with client-side previews).
+        """
+        missing_tmp_files = False
+        for tmp_path, path in zip(self.get_file_paths(tmp=True), self.get_file_paths()):
+            try:
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                missing_tmp_files = True
+        if missing_tmp_files:
+            self.render()
+
+    def render(self, original_image=None, tmp=False):
+        """Render the thumbnail's file from its crop data and dimensions."""
+        if not self.image_id:
+            raise Exception(
+                u"Cannot render thumbnails which are not associated with an image")
+        size = Size(self.name, w=self.width, h=self.height, retina=self.retina,
+            widths=self.get_widths(), formats=self.get_extra_formats(), profile=self.profile or None,
+            max_bytes=self.max_bytes)
+        self.image._save_thumb(size, original_image, thumb=self, tmp=tmp, commit=False,
+            thumb_format=self.format)
+
     def to_dict(self):
         """Returns a dict of the thumb's values which are JSON serializable."""
         dct = {}
@@ -129,6 +231,16 @@ class Thumb(models.Model):
             return None
         return Box(x1, y1, x2, y2)
 
+    def get_original_size(self):
+        """
+        Returns the (width, height) of the thumb's original image, using
+        the dimensions stored on the Image if possible.
+        """
+        image = self.image
+        if image.width and image.height:
+            return (image.width, image.height)
+        return image.get_image_size()
+
     def crop(self, original_image=None, size=None, w=None, h=None):
         if original_image is None:
             if not self.pk:
@@ -141,7 +253,7 @@ class Thumb(models.Model):
                     u"The `original_image` argument is required for"
                     u" thumbnails which are not associated with an image")
 
-            original_image = self.image
+            original_image = self.get_original_size()
 
         crop_box = self.get_crop_box()
         if crop_box is None:
@@ -240,6 +352,7 @@ class Image(models.Model):
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_image' % cropduster_settings.CROPDUSTER_DB_PREFIX
         unique_together = ("content_type", "object_id", "field_identifier")
+        index_together = [("content_type", "prev_object_id")]
 
     def __unicode__(self):
         return self.get_image_url()
@@ -265,13 +378,15 @@ class Image(models.Model):
         return os.path.splitext(safe_str_path(self.image.path))[1]
 
     @staticmethod
-    def get_file_for_size(image, size_name='original', tmp=False):
+    def get_file_for_size(image, size_name='original', tmp=False, format=None):
         if isinstance(image, six.string_types):
             image = VirtualFieldFile(image)
         if not image:
             return None
         path, basename = os.path.split(safe_str_path(image.name))
         filename, extension = os.path.splitext(basename)
+        if format:
+            extension = IMAGE_EXTENSIONS.get(format.upper(), '.%s' % format.lower())
         if size_name == 'preview':
             size_name = '_preview'
         if tmp:
@@ -302,35 +417,60 @@ class Image(models.Model):
             return preview_img
 
         preview_file = cls.get_file_for_size(image_file, '_preview')
-        process_image(pil_img, safe_str_path(preview_file.path), fit_preview)
+        process_image(pil_img, safe_str_path(preview_file.path), fit_preview,
+            profile=cropduster_settings.CROPDUSTER_PREVIEW_ENCODER_PROFILE)
         return preview_file
 
     def save_preview(self, preview_w=None, preview_h=None):
         return Image.save_preview_file(self.image, preview_w=preview_w, preview_h=preview_h)
 
+    def get_thumbs_by_name(self):
+        """
+        Returns a dict of the image's thumbs keyed by name, loaded with one
+        query (or from the prefetch_related cache of `thumbs`).
+        """
+        if not self.pk:
+            return {}
+        return dict((t.name, t) for t in self.thumbs.all())
+
+    def get_thumb(self, size_name):
+        """Returns the thumb named `size_name`, or None if there is none."""
+        return self.get_thumbs_by_name().get(size_name)
+
     def has_thumb(self, size_name):
-        try:
-            self.thumbs.get(name=size_name)
-        except Thumb.DoesNotExist:
-            return False
-        else:
-            return True
+        return self.get_thumb(size_name) is not None
+
+    def get_thumb_file_format(self, size_name):
+        """
+        Returns the format of the thumb named `size_name`, or None if it is
+        missing or was saved in the format of the original image.
+        """
+        thumb = self.get_thumb(size_name)
+        return getattr(thumb, 'format', None) or None
 
     def get_image_filesize(self, size_name='original'):
         size_name = size_name or 'original'
-        if size_name != 'original' and not self.has_thumb(size_name):
-            return 0
-        return os.path.getsize(self.get_image_path(size_name))
+        format = None
+        if size_name != 'original':
+            thumb = self.get_thumb(size_name)
+            if thumb is None:
+                return 0
+            format = thumb.format or None
+        return os.path.getsize(self.get_image_path(size_name, format=format))
 
     def get_image_filename(self, size_name='original'):
         size_name = size_name or 'original'
-        if size_name != 'original' and not self.has_thumb(size_name):
-            return ''
-        return os.path.basename(self.get_image_path(size_name))
-
-    def get_image_path(self, size_name='original', tmp=False):
+        format = None
+        if size_name != 'original':
+            thumb = self.get_thumb(size_name)
+            if thumb is None:
+                return ''
+            format = thumb.format or None
+        return os.path.basename(self.get_image_path(size_name, format=format))
+
+    def get_image_path(self, size_name='original', tmp=False, format=None):
         size_name = size_name or 'original'
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format)
         if not converted:
             return u''
         else:
@@ -372,8 +512,37 @@ class Image(models.Model):
                     field.generic_field.field_identifier == self.field_identifier):
                 field_model_class.objects.filter(pk=self.object_id).update(**{field.attname: self.path or ''})
 
-    def get_image_url(self, size_name='original', tmp=False):
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+    def get_source_signature(self):
+        """
+        A cheap signature of the original image file (its name, size and
+        modification time), which changes whenever the file is replaced.
+        """
+        try:
+            stat = os.stat(safe_str_path(self.image.path))
+        except (ValueError, IOError, OSError):
+            return None
+        return u'%s:%d:%d' % (self.image.name, stat.st_size, int(stat.st_mtime))
+
+    def get_render_fingerprint(self, thumb, crop_box):
+        """
+        Returns a hash of the inputs to rendering `thumb` from `crop_box`
+        of the original image, or '' if the original cannot be identified.
+        """
+        source_signature = self.get_source_signature()
+        if not source_signature:
+            return ''
+        profile = thumb.profile or cropduster_settings.CROPDUSTER_ENCODER_PROFILE
+        inputs = [
+            RENDER_VERSION, source_signature, list(crop_box.as_tuple()),
+            thumb.width, thumb.height, thumb.retina, thumb.widths, thumb.format,
+            thumb.extra_formats, thumb.max_bytes, profile,
+            cropduster_settings.CROPDUSTER_ENCODER_PROFILES.get(profile),
+            cropduster_settings.get_jpeg_quality(thumb.width, thumb.height),
+        ]
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_image_url(self, size_name='original', tmp=False, format=None):
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format)
         return getattr(converted, 'url', None) or u''
 
     def get_image_size(self, size_name=None):
@@ -383,12 +552,10 @@ class Image(models.Model):
         the original image.
         """
         if size_name is not None:
-            try:
-                thumb = self.thumbs.get(name=size_name)
-            except Thumb.DoesNotExist:
+            thumb = self.get_thumb(size_name)
+            if thumb is None:
                 return (0, 0)
-            else:
-                return (thumb.width, thumb.height)
+            return (thumb.width, thumb.height)
 
         # Get the original size
         if not self.image or not os.path.exists(safe_str_path(self.image.path)):
@@ -427,7 +594,8 @@ class Image(models.Model):
             setattr(obj, cropduster_field.name, None)
             obj.save()
 
-    def save_size(self, size, thumb=None, image=None, tmp=False, standalone=False, permissive=False):
+    def save_size(self, size, thumb=None, image=None, tmp=False, standalone=False, permissive=False,
+            render=True):
         thumbs = {}
         if not image and not self.image:
             raise Exception("Cannot save sizes without an image")
@@ -439,12 +607,17 @@ class Image(models.Model):
                 raise ImproperlyConfigured(u"standalone mode used, but not installed.")
             return self._save_standalone_thumb(size, image, thumb)
 
+        # Decided once for the image, since it inspects its pixels
+        thumb_format = get_thumb_format(image) or ''
+
         for sz in Size.flatten([size]):
             try:
                 if thumb and sz.is_auto:
-                    new_thumb = self._save_thumb(sz, image, ref_thumb=thumb, tmp=tmp)
+                    new_thumb = self._save_thumb(sz, image, ref_thumb=thumb, tmp=tmp, render=render,
+                        thumb_format=thumb_format)
                 else:
-                    thumb = new_thumb = self._save_thumb(sz, image, thumb, tmp=tmp)
+                    thumb = new_thumb = self._save_thumb(sz, image, thumb, tmp=tmp, render=render,
+                        thumb_format=thumb_format)
             except CropDusterResizeException:
                 if permissive or not sz.required:
                     if not sz.is_auto:
@@ -469,20 +642,17 @@ class Image(models.Model):
             h=(size.h or thumb.crop_h))
         thumb_image = thumb_crop.create_image(thumb_path, width=thumb.width, height=thumb.height)
         thumb_image.crop.add_xmp_to_crop(thumb_path, size, original_image=image)
-        md5 = hashlib.md5()
-        with open(thumb_path, mode='rb') as f:
-            md5.update(f.read())
-        thumb.name = md5.hexdigest()[0:9]
+        thumb.name = get_file_md5(thumb_path)[0:9]
         os.rename(thumb_path, self.get_image_path(thumb.name))
         return thumb
 
-    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, commit=True):
+    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, commit=True,
+            render=True, thumb_format=None):
         image = image or PIL.Image.open(safe_str_path(self.image.path))
-        if not thumb and self.pk:
-            try:
-                thumb = self.thumbs.get(name=size.name)
-            except Thumb.DoesNotExist:
-                pass
+        if thumb_format is None:
+            thumb_format = get_thumb_format(image) or ''
+        if not thumb:
+            thumb = self.get_thumb(size.name)
         if not thumb:
             thumb = Thumb(name=size.name)
         elif not thumb.name:
@@ -492,11 +662,60 @@ class Image(models.Model):
             thumb.reference_thumb = ref_thumb or thumb.reference_thumb
 
         thumb_crop = thumb.crop(image, size)
-        thumb_path = self.get_image_path(size.name, tmp=tmp)
-        thumb_image = thumb_crop.create_image(thumb_path, width=thumb.width, height=thumb.height)
 
-        if StandaloneImage:
-            thumb_image.crop.add_xmp_to_crop(thumb_path, size, original_image=image)
+        # Only render a @2x version if the crop has the pixels for it
+        crop_w, crop_h = thumb_crop.box.size
+        thumb.retina = bool(size.retina and
+            crop_w >= thumb.width * 2 and crop_h >= thumb.height * 2)
+
+        # srcset widths are rendered only if they are smaller than the thumb
+        thumb.widths = u','.join([u'%d' % w for w in (size.widths or []) if w < thumb.width])
+
+        # Opaque photographic PNGs may be saved as e.g. JPEG instead
+        thumb.format = thumb_format
+        output_format = (thumb_format or image.format or '').upper()
+
+        # Additional formats, if PIL can write them (animated gifs stay gifs)
+        formats = []
+        if size.formats and not is_animated_gif(image):
+            formats = [f for f in size.formats
+                       if f.upper() != output_format and is_format_supported(f)]
+        thumb.extra_formats = u','.join(formats)
+        thumb.profile = size.profile or ''
+        thumb.max_bytes = size.max_bytes or None
+
+        if render:
+            # Skip rendering if nothing has changed since the files were
+            # rendered. Temporary files are not tracked by the fingerprint.
+            fingerprint = self.get_render_fingerprint(thumb, thumb_crop.box)
+            if not tmp and fingerprint and fingerprint == thumb.fingerprint and all(
+                    os.path.exists(p) for p in thumb.get_file_paths(self)):
+                render = False
+            thumb.fingerprint = fingerprint
+        else:
+            thumb.fingerprint = ''
+
+        if render:
+            # Render every version in one pass, from the largest down, each
+            # one resampled from the one before it
+            outputs = [(thumb.name, thumb.width, thumb.height)]
+            if thumb.retina:
+                outputs.insert(0, (thumb.retina_name, thumb.width * 2, thumb.height * 2))
+            for w in thumb.get_widths():
+                outputs.append((thumb.get_width_name(w), w, thumb.get_width_height(w)))
+
+            renders = [(self.get_image_path(name, tmp=tmp, format=thumb.format or None), w, h)
+                       for name, w, h in outputs]
+            thumb_image = thumb_crop.create_image(*renders[0], derivatives=renders[1:],
+                format=thumb.format or None, formats=thumb.get_extra_formats(),
+                profile=thumb.profile or None,
+                max_bytes=thumb.get_max_bytes if thumb.max_bytes else None)
+
+            if StandaloneImage:
+                # Every render of the thumb gets the same metadata
+                xmp_meta = thumb_image.crop.get_xmp(size, original_image=image)
+                for path, w, h in renders:
+                    thumb_image.crop.add_xmp_to_crop(path, size, xmp_meta=xmp_meta)
 
         if commit:
             thumb.save()
@@ -2,8 +2,8 @@ from __future__ import division
 
 import os
 import re
+import copy
 import math
-import hashlib
 import tempfile
 
 import PIL.Image
@@ -15,6 +15,11 @@ from django.utils.six.moves import filter
 
 from .settings import CROPDUSTER_RETAIN_METADATA
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 if hasattr(six.moves.builtins, 'file'):
     BUILTIN_FILE_TYPE = file
@@ -30,11 +35,16 @@ INFINITY = float('inf')
 
 class Size(object):
 
-    parent = None
+    __slots__ = (
+        'name', 'label', 'width', 'height', 'retina', 'auto', 'parent', 'required',
+        'min_w', 'min_h', 'max_w', 'max_h', 'min_aspect', 'max_aspect', 'widths',
+        'formats', 'profile', 'max_bytes', '_frozen', '_json')
 
     def __init__(self, name, label=None, w=None, h=None, retina=False, auto=None, min_w=None, min_h=None,
-            max_w=None, max_h=None, required=True):
+            max_w=None, max_h=None, required=True, widths=None, formats=None, profile=None,
+            max_bytes=None):
 
+        self.parent = None
         self.min_w = max(w or 1, min_w or 1) or 1
         self.min_h = max(h or 1, min_h or 1) or 1
         self.max_w = max_w
@@ -58,6 +68,14 @@ class Size(object):
         self.height = h
         self.label = label or u' '.join(filter(None, re.split(r'[_\-]', name))).title()
         self.required = required
+        # Smaller widths of the crop to render for srcset, e.g. [320, 640, 960]
+        self.widths = sorted(set(widths), reverse=True) if widths else None
+        # Additional formats to render the crop in, e.g. ['avif', 'webp']
+        self.formats = [f.lower() for f in formats] if formats else None
+        # The encoder profile to save the crop with (see CROPDUSTER_ENCODER_PROFILES)
+        self.profile = profile
+        # Byte budget for the crop at w x h; the JPEG quality is lowered to meet it
+        self.max_bytes = max_bytes
 
         self.min_aspect = (self.w / self.h) if (self.w and self.h) else 0
         self.max_aspect = self.min_aspect or INFINITY
@@ -74,6 +92,53 @@ class Size(object):
         if self.h and self.max_w:
             self.max_aspect = min(self.max_aspect, self.max_w / self.h)
 
+    def __setattr__(self, name, value):
+        if self.is_frozen:
+            raise AttributeError("Size %r is frozen" % self.name)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k)])
+
+    def __setstate__(self, state):
+        for k, v in six.iteritems(state):
+            object.__setattr__(self, k, v)
+
+    def __copy__(self):
+        if self.is_frozen:
+            return self
+        copied = Size.__new__(Size)
+        copied.__setstate__(self.__getstate__())
+        return copied
+
+    def __deepcopy__(self, memo):
+        if self.is_frozen:
+            return self
+        copied = Size.__new__(Size)
+        memo[id(self)] = copied
+        copied.__setstate__(copy.deepcopy(self.__getstate__(), memo))
+        return copied
+
+    @property
+    def is_frozen(self):
+        return getattr(self, '_frozen', False)
+
+    def freeze(self):
+        """
+        Makes the size and its auto sizes immutable, so that they can be
+        safely shared (e.g. cached between requests). Returns the size.
+        """
+        if self.auto:
+            for auto_size in self.auto:
+                auto_size.freeze()
+            self.auto = tuple(self.auto)
+        if self.widths:
+            self.widths = tuple(self.widths)
+        if self.formats:
+            self.formats = tuple(self.formats)
+        object.__setattr__(self, '_frozen', True)
+        return self
+
     def __unicode__(self):
         name = u'Size %s (%s):' % (self.label, self.name)
         if self.auto:
@@ -125,8 +190,13 @@ class Size(object):
 
         if isinstance(crop, Thumb):
             crop_box = crop.get_crop_box()
+            if original_image is None:
+                original_image = crop.get_original_size()
             crop = Crop(crop_box, original_image)
 
+        return crop.best_fit(**self.get_best_fit_kwargs())
+
+    def get_best_fit_kwargs(self):
         best_fit_kwargs = {
             'min_w': self.min_w or self.width,
             'min_h': self.min_h or self.height,
@@ -137,7 +207,7 @@ class Size(object):
         }
         if self.width and self.height:
             best_fit_kwargs.update({'w': self.width, 'h': self.height})
-        return crop.best_fit(**best_fit_kwargs)
+        return best_fit_kwargs
 
     def __serialize__(self):
         data = {
@@ -155,17 +225,40 @@ class Size(object):
         }
         if self.auto:
             data['auto'] = [sz.__serialize__() for sz in self.auto]
+        if self.widths:
+            data['widths'] = list(self.widths)
+        if self.formats:
+            data['formats'] = list(self.formats)
+        if self.profile:
+            data['profile'] = self.profile
+        if self.max_bytes:
+            data['max_bytes'] = self.max_bytes
 
         return data
 
 
 class Box(object):
+    """An immutable, hashable rectangle."""
+
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
 
     def __init__(self, x1, y1, x2, y2):
-        self.x1 = x1
-        self.y1 = y1
-        self.x2 = x2
-        self.y2 = y2
+        object.__setattr__(self, 'x1', x1)
+        object.__setattr__(self, 'y1', y1)
+        object.__setattr__(self, 'x2', x2)
+        object.__setattr__(self, 'y2', y2)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Box objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Box objects are immutable")
+
+    def __reduce__(self):
+        return (Box, self.as_tuple())
+
+    def __repr__(self):
+        return 'Box(%r, %r, %r, %r)' % self.as_tuple()
 
     @property
     def w(self):
@@ -201,18 +294,50 @@ class Box(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.as_tuple())
+
 
 class Crop(object):
 
-    def __init__(self, box, image):
-        if isinstance(image, six.string_types):
-            image = PIL.Image.open(image)
+    __slots__ = ('box', 'image', 'bounds')
 
+    def __init__(self, box, image):
+        """
+        `image` can be a PIL image, the path to an image, or a (width, height)
+        tuple. A crop created from dimensions is purely geometric: it never
+        touches the filesystem, and its `image` is None.
+        """
         self.box = box
-        self.image = image
-        self.bounds = Box(0, 0, *image.size)
-
-    def create_image(self, output_filename, width, height):
+        if isinstance(image, tuple):
+            self.image = None
+            self.bounds = Box(0, 0, *image)
+        else:
+            if isinstance(image, six.string_types):
+                image = PIL.Image.open(image)
+            self.image = image
+            self.bounds = Box(0, 0, *image.size)
+
+    def with_box(self, box):
+        """Returns a Crop of the same image (or bounds) with a new box."""
+        crop = Crop.__new__(Crop)
+        crop.box = box
+        crop.image = self.image
+        crop.bounds = self.bounds
+        return crop
+
+    def create_image(self, output_filename, width, height, derivatives=None, format=None,
+            formats=None, profile=None, max_bytes=None):
+        """
+        Crops and resizes the image to `width` x `height`, saving the result
+        to `output_filename`. `derivatives` is an optional list of
+        (filename, width, height) tuples, each of which is resampled from
+        the preceding output in the same pass (e.g. a 1x from a 2x image).
+        Outputs are saved in `format`, if given, instead of the format of the
+        image, and also in each of the additional `formats`, using the
+        parameters of encoder `profile`, within byte budget `max_bytes` (see
+        process_image).
+        """
         from cropduster.utils import process_image, get_image_extension
 
         temp_file = tempfile.NamedTemporaryFile(suffix=get_image_extension(self.image), delete=False)
@@ -229,7 +354,17 @@ class Crop(object):
             im = im.crop(crop_args)
             return smart_resize(im, final_w=width, final_h=height)
 
-        new_image = process_image(image, output_filename, crop_and_resize_callback)
+        def get_resize_callback(w, h):
+            def resize_callback(im):
+                from cropduster.utils import smart_resize
+                return smart_resize(im, final_w=w, final_h=h)
+            return resize_callback
+
+        derivatives = [(filename, get_resize_callback(w, h)) for filename, w, h in (derivatives or [])]
+
+        new_image = process_image(image, output_filename, crop_and_resize_callback,
+            derivatives=derivatives, format=format, formats=formats, profile=profile,
+            max_bytes=max_bytes)
         new_image.crop = self
         temp_file.close()
         os.unlink(temp_filename)
@@ -295,7 +430,7 @@ class Crop(object):
             # scale down the width to maintain aspect ratio
             w = (x2 - x1) * (scale_y / scale_x)
             # unless the scaled width would drop below the min_w
-            if w < min_w:
+            if min_w and w < min_w:
                 w = min_w
             dw = initial_fit.w - w
             x1 += (dw / 2)
@@ -304,12 +439,94 @@ class Crop(object):
             # scale down the height to maintain aspect ratio
             h = (y2 - y1) * (scale_x / scale_y)
             # unless the scaled height would drop below the min_h
-            if h < min_h:
+            if min_h and h < min_h:
                 h = min_h
             dh = initial_fit.h - h
             y1 += (dh / 2)
             y2 = y1 + h
 
+        return self._round_fit(x1, y1, x2, y2, w, h)
+
+    def best_fit_many(self, sizes):
+        """
+        Returns the best fit Crop for each Size in `sizes`. The result is the
+        same as calling ``size.fit_to_crop(crop)`` on each size, but when numpy
+        is available all of the fits are computed in a single vectorized pass.
+        """
+        sizes = list(sizes)
+        if numpy is None or not sizes or not self.box.w or not self.box.h:
+            return [size.fit_to_crop(self) for size in sizes]
+
+        def column(key, default=0):
+            values = [kw.get(key) for kw in fit_kwargs]
+            return numpy.array([default if v is None else v for v in values], dtype=float)
+
+        fit_kwargs = [size.get_best_fit_kwargs() for size in sizes]
+        box = self.box
+        bounds_w, bounds_h = self.bounds.w, self.bounds.h
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            size_w, size_h = column('w'), column('h')
+            min_w, min_h = column('min_w'), column('min_h')
+            min_aspect, max_aspect = column('min_aspect'), column('max_aspect')
+
+            aspect_ratio = numpy.where(
+                (size_w > 0) & (size_h > 0), size_w / size_h, box.aspect_ratio)
+            below_min = (min_aspect > 0) & (aspect_ratio < min_aspect)
+            above_max = ~below_min & (max_aspect > 0) & (aspect_ratio > max_aspect)
+            aspect_ratio = numpy.where(below_min, min_aspect, aspect_ratio)
+            aspect_ratio = numpy.where(above_max, max_aspect, aspect_ratio)
+
+            w = box.w * numpy.sqrt(aspect_ratio / box.aspect_ratio)
+            h = w / aspect_ratio
+
+            # Scale our initial width and height based on the min_w and min_h
+            min_scale = numpy.maximum(
+                numpy.where(min_w > w, min_w / w, 1),
+                numpy.where(min_h > h, min_h / h, 1))
+            w = w * min_scale
+            h = h * min_scale
+
+            midx, midy = box.midpoint
+            x1 = midx - (w / 2)
+            y1 = midy - (h / 2)
+            x2 = x1 + w
+            y2 = y1 + h
+            initial_w = x2 - x1
+            initial_h = y2 - y1
+
+            # scale and translate to fit inside image bounds,
+            # based on initial best fit.
+            x2 = numpy.where(x1 < 0, x2 - x1, x2)
+            x1 = numpy.maximum(x1, 0)
+            overflow_x = x2 > bounds_w
+            x1 = numpy.where(overflow_x, numpy.maximum(bounds_w - initial_w, 0), x1)
+            x2 = numpy.where(overflow_x, bounds_w, x2)
+            scale_x = numpy.where(overflow_x, (x2 - x1) / initial_w, 1)
+
+            y2 = numpy.where(y1 < 0, y2 - y1, y2)
+            y1 = numpy.maximum(y1, 0)
+            overflow_y = y2 > bounds_h
+            y1 = numpy.where(overflow_y, numpy.maximum(bounds_h - initial_h, 0), y1)
+            y2 = numpy.where(overflow_y, bounds_h, y2)
+            scale_y = numpy.where(overflow_y, (y2 - y1) / initial_h, 1)
+
+            # scale down the width (or height) to maintain aspect ratio,
+            # unless it would drop below the min_w (or min_h)
+            shrink_w = scale_y < scale_x
+            new_w = numpy.maximum((x2 - x1) * (scale_y / scale_x), min_w)
+            new_h = numpy.maximum((y2 - y1) * (scale_x / scale_y), min_h)
+            w = numpy.where(shrink_w, new_w, w)
+            h = numpy.where(shrink_w, h, new_h)
+            x1 = numpy.where(shrink_w, x1 + (initial_w - w) / 2, x1)
+            x2 = numpy.where(shrink_w, x1 + w, x2)
+            y1 = numpy.where(shrink_w, y1, y1 + (initial_h - h) / 2)
+            y2 = numpy.where(shrink_w, y2, y1 + h)
+
+        return [self._round_fit(*args) for args in zip(
+            x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist(), w.tolist(), h.tolist())]
+
+    def _round_fit(self, x1, y1, x2, y2, w, h):
         w = int(round(w))
         h = int(round(h))
 
@@ -330,9 +547,14 @@ class Crop(object):
             elif y1 > self.bounds.y1:
                 y1 -= 1
 
-        return Crop(Box(x1, y1, x2, y2), self.image)
+        return self.with_box(Box(x1, y1, x2, y2))
 
-    def add_xmp_to_crop(self, cropped_image, size, original_image=None):
+    def add_xmp_to_crop(self, cropped_image, size, original_image=None, xmp_meta=None):
+        """
+        Write the XMP metadata of the crop into the file of `cropped_image`.
+        To write the same metadata into several renders of the crop, get
+        it once with get_xmp() and pass it as `xmp_meta`.
+        """
         try:
             from cropduster.standalone.metadata import libxmp, file_format_supported
         except ImproperlyConfigured:
@@ -341,46 +563,15 @@ class Crop(object):
         if not libxmp:
             return
 
-        from cropduster.models import Image, Thumb
-
-        def get_image_path(img):
-            if isinstance(img, ImageFile):
-                path = img.filename
-            elif isinstance(img, BUILTIN_FILE_TYPE):
-                path = img.name
-            elif isinstance(img, FieldFile):
-                path = img.path
-            elif isinstance(img, Thumb):
-                image = img.image
-                if not img:
-                    return None
-                path = image.get_path(img.name)
-            elif isinstance(img, Image):
-                path = img.get_path('original')
-            elif isinstance(img, six.string_types):
-                path = img
-            else:
-                path = None
-            return path
-
-        image_path = get_image_path(cropped_image)
+        image_path = self._get_image_path(cropped_image)
 
         if not image_path:
             return
 
-        xmp_file = libxmp.XMPFiles(file_path=image_path, open_forupdate=True)
-
-        original_metadata = None
-        if original_image and CROPDUSTER_RETAIN_METADATA:
-            original_image_path = get_image_path(original_image)
-            if original_image_path:
-                try:
-                    original_xmp_file = libxmp.XMPFiles(file_path=original_image_path)
-                    original_metadata = original_xmp_file.get_xmp()
-                except:
-                    pass
+        if xmp_meta is None:
+            xmp_meta = self.get_xmp(size, original_image=original_image)
 
-        xmp_meta = self.generate_xmp(size, original_metadata=original_metadata)
+        xmp_file = libxmp.XMPFiles(file_path=image_path, open_forupdate=True)
 
         if not xmp_file.can_put_xmp(xmp_meta):
             if not file_format_supported(image_path):
@@ -393,18 +584,60 @@ class Crop(object):
         xmp_file.put_xmp(xmp_meta)
         xmp_file.close_file()
 
-    def generate_xmp(self, size, original_metadata=None):
-        from cropduster.standalone.metadata import libxmp
-        from cropduster.utils import json
+    def get_xmp(self, size, original_image=None):
+        """
+        Returns the XMP metadata of the crop for `size`, or None if libxmp
+        is not installed. With CROPDUSTER_RETAIN_METADATA, it starts from a
+        copy of the metadata of `original_image`, which is only read from
+        the file once however many crops are made from it.
+        """
+        try:
+            from cropduster.standalone.metadata import libxmp, read_xmp
+        except ImproperlyConfigured:
+            libxmp = None
 
-        NS_MWG_RS = "http://www.metadataworkinggroup.com/schemas/regions/"
-        NS_XMPMM = "http://ns.adobe.com/xap/1.0/mm/"
-        NS_CROP = "http://ns.thealtantic.com/cropduster/1.0/"
+        if not libxmp:
+            return None
 
-        md5 = hashlib.md5()
-        with open(self.image.filename, mode='rb') as f:
-            md5.update(f.read())
-        digest = md5.hexdigest()
+        original_metadata = None
+        if original_image and CROPDUSTER_RETAIN_METADATA:
+            original_image_path = self._get_image_path(original_image)
+            if original_image_path:
+                try:
+                    original_metadata = read_xmp(original_image_path)
+                except:
+                    pass
+
+        return self.generate_xmp(size, original_metadata=original_metadata)
+
+    @staticmethod
+    def _get_image_path(img):
+        from cropduster.models import Image, Thumb
+
+        if isinstance(img, ImageFile):
+            path = img.filename
+        elif isinstance(img, BUILTIN_FILE_TYPE):
+            path = img.name
+        elif isinstance(img, FieldFile):
+            path = img.path
+        elif isinstance(img, Thumb):
+            image = img.image
+            if not img:
+                return None
+            path = image.get_path(img.name)
+        elif isinstance(img, Image):
+            path = img.get_path('original')
+        elif isinstance(img, six.string_types):
+            path = img
+        else:
+            path = None
+        return path
+
+    def generate_xmp(self, size, original_metadata=None):
+        from cropduster.standalone.metadata import libxmp, NS_CROP, NS_MWG_RS, NS_XMPMM
+        from cropduster.utils import json, get_file_md5
+
+        digest = get_file_md5(self.image.filename)
 
         md = original_metadata or libxmp.XMPMeta()
         md.register_namespace(NS_XMPMM, 'xmpMM')
@@ -45,6 +45,41 @@ def get_jpeg_quality(width, height):
             "CROPDUSTER_JPEG_QUALITY setting must be either a callable "
             "or a numeric value, got type %s" % (type(CROPDUSTER_JPEG_QUALITY).__name__))
 
+DEFAULT_ENCODER_PROFILES = {
+    'default': {},
+    'fast': {
+        'JPEG': {'optimize': False, 'progressive': False},
+        'PNG': {'optimize': False, 'compress_level': 1},
+        'WEBP': {'method': 0},
+    },
+    'small': {
+        'JPEG': {'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+        'PNG': {'optimize': True, 'compress_level': 9},
+        'WEBP': {'method': 6},
+    },
+}
+
+CROPDUSTER_ENCODER_PROFILES = dict(DEFAULT_ENCODER_PROFILES,
+    **getattr(settings, 'CROPDUSTER_ENCODER_PROFILES', {}))
+
+CROPDUSTER_ENCODER_PROFILE = getattr(settings, 'CROPDUSTER_ENCODER_PROFILE', 'default')
+
+CROPDUSTER_PREVIEW_ENCODER_PROFILE = getattr(settings, 'CROPDUSTER_PREVIEW_ENCODER_PROFILE', 'fast')
+
+
+def get_encoder_params(profile, format):
+    profile = profile or CROPDUSTER_ENCODER_PROFILE
+    try:
+        params = CROPDUSTER_ENCODER_PROFILES[profile]
+    except KeyError:
+        raise ImproperlyConfigured(
+            "Unknown encoder profile %r; the CROPDUSTER_ENCODER_PROFILES setting "
+            "has %s" % (profile, ', '.join(sorted(CROPDUSTER_ENCODER_PROFILES))))
+    return dict(params.get((format or '').upper(), {}))
+
+
+CROPDUSTER_MIN_JPEG_QUALITY = getattr(settings, 'CROPDUSTER_MIN_JPEG_QUALITY', 40)
+
 JPEG_SAVE_ICC_SUPPORTED = (LooseVersion(getattr(PIL, 'PILLOW_VERSION', '0'))
     >= LooseVersion('2.2.1'))
 
@@ -55,3 +90,21 @@ if CROPDUSTER_GIFSICLE_PATH is None:
     CROPDUSTER_GIFSICLE_PATH = distutils.spawn.find_executable("gifsicle")
 
 CROPDUSTER_RETAIN_METADATA = getattr(settings, 'CROPDUSTER_RETAIN_METADATA', False)
+
+CROPDUSTER_CLIENT_SIDE_PREVIEW = getattr(settings, 'CROPDUSTER_CLIENT_SIDE_PREVIEW', False)
+
+CROPDUSTER_DEDUPLICATE_UPLOADS = getattr(settings, 'CROPDUSTER_DEDUPLICATE_UPLOADS', False)
+
+CROPDUSTER_DEDUPLICATE_DIR = getattr(settings, 'CROPDUSTER_DEDUPLICATE_DIR', '_cropduster_originals')
+
+CROPDUSTER_CONVERT_PNG_FORMAT = getattr(settings, 'CROPDUSTER_CONVERT_PNG_FORMAT', None)
+
+CROPDUSTER_CONVERT_PNG_MIN_COLORS = getattr(settings, 'CROPDUSTER_CONVERT_PNG_MIN_COLORS', 4096)
+
+CROPDUSTER_REMOTE_CONNECT_TIMEOUT = getattr(settings, 'CROPDUSTER_REMOTE_CONNECT_TIMEOUT', 5)
+
+CROPDUSTER_REMOTE_READ_TIMEOUT = getattr(settings, 'CROPDUSTER_REMOTE_READ_TIMEOUT', 30)
+
+CROPDUSTER_REMOTE_MAX_BYTES = getattr(settings, 'CROPDUSTER_REMOTE_MAX_BYTES', 20 * 1024 * 1024)
+
+CROPDUSTER_REMOTE_CACHE_TIMEOUT = getattr(settings, 'CROPDUSTER_REMOTE_CACHE_TIMEOUT', 300)
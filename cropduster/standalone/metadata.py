@@ -1,13 +1,18 @@
 import os
 import re
+import copy
 import ctypes
+
 import PIL.Image
 
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import six
+from django.utils.functional import cached_property
+from django.utils.six.moves import range
 
 from cropduster.files import ImageFile
 from cropduster.utils import json
+from cropduster.utils.cache import LRUCache, file_cache_key
 
 try:
     import libxmp
@@ -157,6 +162,53 @@ def file_format_supported(file_path):
     return bool(format_options & FormatOptions.XMP_FMT_CAN_INJECT_XMP)
 
 
+NS_CROP = "http://ns.thealtantic.com/cropduster/1.0/"
+NS_MWG_RS = "http://www.metadataworkinggroup.com/schemas/regions/"
+NS_XMPMM = "http://ns.adobe.com/xap/1.0/mm/"
+
+# The namespaces of the properties MetadataDict extracts
+METADATA_NAMESPACES = (NS_CROP, NS_MWG_RS, NS_XMPMM)
+
+# Maximum number of files whose parsed metadata is kept by MetadataDict
+METADATA_CACHE_MAX = 128
+
+# Matches a property name with an index, e.g. 'RegionList[1]'
+INDEXED_NAME_RE = re.compile(r'\A(.*)\[(\d+)\]\Z')
+DERIVED_FROM_PREFIX_RE = re.compile(r'\Axmp\.did:')
+
+_metadata = LRUCache(METADATA_CACHE_MAX)
+
+# Maximum number of files whose XMP packets are kept by read_xmp()
+XMP_PACKET_CACHE_MAX = 32
+
+_xmp_packets = LRUCache(XMP_PACKET_CACHE_MAX)
+
+
+def read_xmp(file_path):
+    """
+    Returns a new libxmp.XMPMeta with the XMP metadata of the file at
+    `file_path`, or None if it has none. The file is opened and parsed
+    once (until it is modified); later calls return a copy parsed from
+    the packet serialized then, which the caller is free to change.
+    """
+    key = file_cache_key(file_path)
+    packet = _xmp_packets.get(key, LRUCache.missing)
+    if packet is LRUCache.missing:
+        xmp_file = libxmp.XMPFiles(file_path=file_path)
+        try:
+            xmp_meta = xmp_file.get_xmp()
+        finally:
+            xmp_file.close_file()
+        packet = xmp_meta.serialize_to_unicode() if xmp_meta is not None else None
+        _xmp_packets.set(key, packet)
+        return xmp_meta
+    if packet is None:
+        return None
+    xmp_meta = libxmp.XMPMeta()
+    xmp_meta.parse_from_str(packet)
+    return xmp_meta
+
+
 class MetadataDict(dict):
     """
     Normalizes the key/values returned from libxmp.file_to_dict()
@@ -173,33 +225,43 @@ class MetadataDict(dict):
         (note that list from libxmp.file_to_dict() are 1-indexed)
       - Converts stDim:* and stArea:* values into ints and floats,
         respectively
+
+    Only the properties in METADATA_NAMESPACES are extracted. The result
+    for a file is cached until the file is modified, and each instance is
+    given its own copy of it.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, image_file=None):
         self.file_path = file_path
-        ns_dict = file_to_dict(file_path)
-        self.clean(ns_dict)
+        self.image_file = image_file
+        key = file_cache_key(file_path)
+        metadata = _metadata.get(key)
+        if metadata is None:
+            self.clean(file_to_dict(file_path))
+            _metadata.set(key, copy.deepcopy(dict(self)))
+        else:
+            self.update(copy.deepcopy(metadata))
 
     def clean(self, ns_dict):
         for ns, values in six.iteritems(ns_dict):
+            if ns not in METADATA_NAMESPACES:
+                continue
             for k, v, opts in values:
                 current = self
                 bits = k.split('/')
                 for bit in bits[:-1]:
                     bit = bit.rpartition(':')[-1]
-                    m = re.search(r'^(.*)\[(\d+)\](?=\/|\Z)', bit)
+                    m = bit.endswith(']') and INDEXED_NAME_RE.match(bit)
                     if not m:
                         current = current.setdefault(bit, {})
                     else:
                         bit = m.group(1)
                         index = int(m.group(2)) - 1
-                        if isinstance(current.get(bit), list):
-                            if len(current[bit]) < (index + 1):
-                                current[bit] += [{}] * (1 + index - len(current[bit]))
-                            current = current[bit][index]
-                        else:
-                            current[bit] = [{}] * (index + 1)
-                            current = current[bit][index]
+                        items = current.get(bit)
+                        if not isinstance(items, list):
+                            items = current[bit] = []
+                        items.extend({} for i in range(index + 1 - len(items)))
+                        current = items[index]
 
                 if opts.get('VALUE_IS_ARRAY') and not v:
                     v = []
@@ -208,7 +270,7 @@ class MetadataDict(dict):
 
                 ns_prefix, sep, k = bits[-1].rpartition(':')
 
-                if ns_prefix == 'stDim' and k in ('w, h'):
+                if ns_prefix == 'stDim' and k in ('w', 'h'):
                     try:
                         v = int(v)
                     except (TypeError, ValueError):
@@ -219,20 +281,19 @@ class MetadataDict(dict):
                     except (TypeError, ValueError):
                         v = None
                 elif k == 'DerivedFrom' and isinstance(v, six.string_types):
-                    v = re.sub(r'^xmp\.did:', '', v).lower()
+                    v = DERIVED_FROM_PREFIX_RE.sub('', v).lower()
                 elif ns_prefix == 'crop' and k == 'json':
                     v = json.loads(v)
                 elif ns_prefix == 'crop' and k == 'md5':
                     v = v.lower()
 
-                m = re.search(r'^(.*)\[(\d+)\](?=\/|\Z)', k)
+                m = k.endswith(']') and INDEXED_NAME_RE.match(k)
                 if m:
                     current = current.setdefault(m.group(1), [{}])
                     k = int(m.group(2)) - 1
 
                 if isinstance(current, list) and isinstance(k, six.integer_types):
-                    if len(current) <= k:
-                        current.append(*([{}] * (1 + k - len(current))))
+                    current.extend({} for i in range(k + 1 - len(current)))
 
                 # Now assign value to current position
                 try:
@@ -249,22 +310,28 @@ class MetadataDict(dict):
         from cropduster.resizing import Size
         size_json = self.get('size', {}).get('json') or None
         if size_json:
-            return size_json
+            # A copy, since the parsed metadata is cached
+            return copy.copy(size_json)
         size_w = self.get('size', {}).get('w') or None
         size_h = self.get('size', {}).get('h') or None
         if not size_w and not size_h:
             return None
         return Size('crop', w=size_w, h=size_h)
 
-    @property
+    @cached_property
     def crop_thumb(self):
         from cropduster.models import Thumb
 
-        try:
-            pil_img = PIL.Image.open(self.file_path)
-        except:
+        if self.image_file is not None:
+            orig_w, orig_h = self.image_file.dimensions
+        else:
+            try:
+                pil_img = PIL.Image.open(self.file_path)
+            except:
+                return None
+            orig_w, orig_h = pil_img.size
+        if not orig_w or not orig_h:
             return None
-        orig_w, orig_h = pil_img.size
         dimensions = self.get('Regions', {}).get('AppliedToDimensions', None)
 
         if not isinstance(dimensions, dict):
@@ -301,4 +368,4 @@ class MetadataImageFile(ImageFile):
     def __init__(self, *args, **kwargs):
         super(MetadataImageFile, self).__init__(*args, **kwargs)
         if self:
-            self.metadata = MetadataDict(self.path)
+            self.metadata = MetadataDict(self.path, image_file=self)
@@ -1,9 +1,10 @@
 import os
-import hashlib
+import re
 
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files import File
 from django.db import models
+from django.utils import six
 
 from generic_plus.utils import get_relative_media_url
 
@@ -11,29 +12,59 @@ from cropduster import settings as cropduster_settings
 from cropduster.fields import CropDusterField
 from cropduster.files import VirtualFieldFile
 from cropduster.resizing import Size
+from cropduster.utils import get_file_md5
+
+
+def normalize_md5(md5):
+    """
+    Returns `md5` as a lowercase hex digest, or None if it is not one.
+    """
+    if not md5 or not isinstance(md5, six.string_types):
+        return None
+    md5 = md5.strip().lower()
+    if not re.match(r'\A[0-9a-f]{32}\Z', md5):
+        return None
+    return md5
 
 
 class StandaloneImageManager(models.Manager):
 
+    def get_by_md5(self, md5):
+        """
+        Returns the StandaloneImage whose original has the hex digest `md5`
+        (in either case), raising StandaloneImage.DoesNotExist if there
+        is none.
+        """
+        md5 = normalize_md5(md5)
+        if md5 is None:
+            # md5=None would match the rows whose hash is NULL
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % self.model._meta.object_name)
+        return self.get(md5=md5)
+
     def get_from_file(self, file_path, upload_to=None, preview_w=None, preview_h=None):
         from cropduster.models import Image
         from cropduster.views.forms import clean_upload_data
 
         image_file = VirtualFieldFile(file_path)
-        md5 = hashlib.md5()
-        image_contents = image_file.read()
-        md5.update(image_contents)
+        md5 = get_file_md5(image_file.path)
         basepath, basename = os.path.split(file_path)
         basefile, extension = os.path.splitext(basename)
         if basefile == 'original':
             basepath, basename = os.path.split(basepath)
             basename += extension
-        standalone, created = self.get_or_create(md5=md5.hexdigest().lower())
+        try:
+            standalone = self.get_by_md5(md5)
+        except self.model.DoesNotExist:
+            standalone, created = self.get_or_create(md5=md5)
+        else:
+            created = False
         if created or not standalone.image:
-            file_data = clean_upload_data({
-                'image': SimpleUploadedFile(basename, image_contents),
-                'upload_to': upload_to,
-            })
+            with open(image_file.path, mode='rb') as f:
+                file_data = clean_upload_data({
+                    'image': File(f, name=basename),
+                    'upload_to': upload_to,
+                })
             file_path = get_relative_media_url(file_data['image'].name)
             standalone.image = file_path
             standalone.save()
@@ -54,7 +85,7 @@ class StandaloneImage(models.Model):
 
     objects = StandaloneImageManager()
 
-    md5 = models.CharField(max_length=32)
+    md5 = models.CharField(max_length=32, unique=True, null=True, blank=True)
     image = CropDusterField(sizes=[Size("crop")])
 
     class Meta:
@@ -62,9 +93,8 @@ class StandaloneImage(models.Model):
         db_table = '%s_standaloneimage' % cropduster_settings.CROPDUSTER_DB_PREFIX
 
     def save(self, **kwargs):
-        if not self.md5:
-            md5_hash = hashlib.md5()
-            with open(self.image.path, mode='rb') as f:
-                md5_hash.update(f.read())
-            self.md5 = md5_hash.digest()
+        if self.md5:
+            self.md5 = normalize_md5(self.md5) or self.md5
+        else:
+            self.md5 = get_file_md5(self.image.path)
         super(StandaloneImage, self).save(**kwargs)
@@ -26,7 +26,7 @@ class CropDusterStandaloneIndex(CropDusterIndex):
             return None
         md5 = self.image_file.metadata.get('md5') or self.image_file.metadata.get('DerivedFrom')
         try:
-            standalone = StandaloneImage.objects.get(md5=md5)
+            standalone = StandaloneImage.objects.get_by_md5(md5)
         except StandaloneImage.DoesNotExist:
             (preview_w, preview_h) = self.preview_size
             standalone = StandaloneImage.objects.get_from_file(self.image_file.name,
@@ -63,9 +63,8 @@ class CropDusterStandaloneIndex(CropDusterIndex):
 
     @cached_property
     def thumbs(self):
-        if getattr(self.image_file.metadata, 'crop_thumb', None):
-            thumb = self.image_file.metadata.crop_thumb
-        else:
+        thumb = getattr(self.image_file.metadata, 'crop_thumb', None)
+        if not thumb:
             orig_w, orig_h = self.image_file.dimensions
             thumb = Thumb(name="crop",
                 crop_x=0, crop_y=0, crop_w=orig_w, crop_h=orig_h,
@@ -78,7 +77,11 @@ class CropDusterStandaloneIndex(CropDusterIndex):
 
     @cached_property
     def orig_image(self):
-        return self.image_file.get_for_size('original')
+        orig_image = self.image_file.get_for_size('original')
+        if orig_image and orig_image.name == self.image_file.name:
+            # Share the dimensions already read from the file's header
+            return self.image_file
+        return orig_image
 
 
 index = CropDusterStandaloneIndex.as_view()
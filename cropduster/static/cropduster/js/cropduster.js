@@ -114,7 +114,10 @@ window.CropDuster = {};
 
     var image_css = function(src, width, height, opts, is_ie) {
         var css = '';
-        src = encodeURI(src || '') + '?v=' + randomDigits(9);
+        src = src || '';
+        if (src.indexOf('data:') !== 0) {
+            src = encodeURI(src) + '?v=' + randomDigits(9);
+        }
         css += 'background-image:url("' + src + '");';
         css += 'width:' + width + 'px;';
         css += 'height:' + height + 'px;';
@@ -209,9 +212,15 @@ window.CropDuster = {};
                     'value': thumb.id,
                     'data-width': thumb.width,
                     'data-height': thumb.height,
-                    'data-tmp-file': 'true',
+                    'data-tmp-file': (thumb.tmp_file === false) ? 'false' : 'true',
                     'selected': 'selected'
                 });
+                if (thumb.preview_url) {
+                    $option.attr('data-preview-url', thumb.preview_url);
+                }
+                if (thumb.extension) {
+                    $option.attr('data-extension', thumb.extension);
+                }
                 $select.append($option);
             }
         },
@@ -336,10 +345,15 @@ window.CropDuster = {};
                 if (data.tmpFile) {
                     name += "_tmp";
                 }
-                var url = [CropDuster.mediaUrl, path, name + ext].join('/');
+                // Thumbs may have been converted to another format
+                var url = [CropDuster.mediaUrl, path, name + (data.extension || ext)].join('/');
                 // This is in place of a negative lookbehind. It replaces all
                 // double slashes that don't follow a colon.
                 url = url.replace(/(:)?\/+/g, function($0, $1) { return $1 ? $0 : '/'; });
+                if (data.previewUrl) {
+                    // Drawn in the crop dialog; the thumb is rendered on save
+                    url = data.previewUrl;
+                }
                 thumbData[slug] = {
                     'image_url': url,
                     'size_slug': slug,
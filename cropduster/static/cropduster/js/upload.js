@@ -455,6 +455,50 @@
         $('#id_thumbs-INITIAL_FORMS').val(initialFormCount);
     };
 
+    // Draws thumbnail previews from the preview image, in place of thumbnails
+    // rendered on the server (see CROPDUSTER_CLIENT_SIDE_PREVIEW). Returns
+    // false, leaving the thumbs untouched, if any preview cannot be drawn.
+    var renderPreviews = function(thumbs) {
+        var img = $('#cropbox')[0];
+        var orig_w = parseInt($('#id_crop-orig_w').val(), 10) || 0;
+        if (!img || !img.naturalWidth || !orig_w || typeof thumbs != 'object') {
+            return false;
+        }
+        var canvas = document.createElement('canvas');
+        if (!canvas.getContext) {
+            return false;
+        }
+        var scale = img.naturalWidth / orig_w;
+        var isPNG = ($('#id_crop-orig_image').val() || '').match(/\.(png|gif)$/i);
+        var previewUrls = {};
+        for (var name in thumbs) {
+            var thumb = thumbs[name];
+            if (thumb.tmp_file === false) {
+                continue;
+            }
+            var box = thumb.crop_box;
+            if (!$.isArray(box) || !thumb.width || !thumb.height) {
+                return false;
+            }
+            canvas.width = thumb.width;
+            canvas.height = thumb.height;
+            canvas.getContext('2d').drawImage(img,
+                box[0] * scale, box[1] * scale,
+                (box[2] - box[0]) * scale, (box[3] - box[1]) * scale,
+                0, 0, thumb.width, thumb.height);
+            try {
+                previewUrls[name] = canvas.toDataURL(isPNG ? 'image/png' : 'image/jpeg');
+            } catch(e) {
+                // The canvas is tainted if the preview image is cross-origin
+                return false;
+            }
+        }
+        for (name in previewUrls) {
+            thumbs[name].preview_url = previewUrls[name];
+        }
+        return true;
+    };
+
     window.getFormData = function() {
         var fields = $(':input').serializeArray();
         var data = {
@@ -697,6 +741,17 @@
                 parent = null;
             }
             if (action == 'crop' && data.thumbs && (cropBox.index + 1) == thumbCount) {
+                if (data.crop && data.crop.client_side_preview && !renderPreviews(data.crop.thumbs)) {
+                    // Have the server render the thumbnails instead
+                    $('#crop-form').ajaxSubmit({
+                        dataType: 'json',
+                        data: {'crop-server_preview': 'on'},
+                        success: function(data, responseType) {
+                            onSuccess(data, responseType, 'crop');
+                        }
+                    });
+                    return;
+                }
                 if (typeof GET_params['callback_fn'] != 'undefined') {
                     parent[GET_params.callback_fn](GET_params['callback_fn'], data);
                 } else {
@@ -3,7 +3,9 @@ import warnings
 
 import django
 from django import template
+from django.utils.encoding import python_2_unicode_compatible
 from cropduster.models import Image
+from cropduster.utils.image import IMAGE_MIME_TYPES
 from cropduster.resizing import Size
 
 
@@ -29,6 +31,13 @@ def get_crop(image, crop_name, **kwargs):
         "url": '/media/path/to/my.jpg',
         "width": 150,
         "height" 150,
+        "retina_url": '/media/path/to/my@2x.jpg',
+        "srcset": '/media/path/to/my.jpg 1x, /media/path/to/my@2x.jpg 2x',
+        "sources": [{
+            "type": 'image/webp',
+            "url": '/media/path/to/my.webp',
+            "srcset": '/media/path/to/my.webp 1x, /media/path/to/my@2x.webp 2x',
+        }],
         "attribution": 'Stock Photoz',
         "attribution_link": 'http://stockphotoz.com',
         "caption": 'Woman laughing alone with salad.',
@@ -37,7 +46,18 @@ def get_crop(image, crop_name, **kwargs):
 
     For use in an image tag or style block like:
 
-        <img src="{{ img.url }}">
+        <img src="{{ img.url }}" srcset="{{ img.srcset }}">
+
+    `retina_url` is None unless a @2x version of the crop was rendered.
+    `sources` lists the additional formats the crop was rendered in (see the
+    `formats` kwarg of Size), for use in <picture> markup:
+
+        <picture>
+          {% for source in img.sources %}
+          <source type="{{ source.type }}" srcset="{{ source.srcset }}">
+          {% endfor %}
+          <img src="{{ img.url }}" srcset="{{ img.srcset }}">
+        </picture>
 
     The `exact_size` kwarg is deprecated.
 
@@ -51,9 +71,7 @@ def get_crop(image, crop_name, **kwargs):
     if not image or not image.related_object:
         return None
 
-    url = getattr(Image.get_file_for_size(image, crop_name), 'url', None)
-
-    thumbs = {thumb.name: thumb for thumb in image.related_object.thumbs.all()}
+    thumbs = image.related_object.get_thumbs_by_name()
     try:
         thumb = thumbs[crop_name]
     except KeyError:
@@ -62,13 +80,116 @@ def get_crop(image, crop_name, **kwargs):
         else:
             return None
 
-    cache_buster = str(time.mktime(thumb.date_modified.timetuple()))[:-2]
+    # Thumbs of opaque photographic PNGs may have been converted to JPEG
+    thumb_format = getattr(thumb, 'format', None) or None
+
+    cache_buster = get_cache_buster(thumb)
+    url = get_thumb_url(image, crop_name, cache_buster, format=thumb_format)
+
+    retina_url = None
+    srcset = "%s 1x" % url
+    if getattr(thumb, 'retina', False):
+        retina_url = get_thumb_url(image, thumb.retina_name, cache_buster, format=thumb_format)
+        srcset = "%s, %s 2x" % (srcset, retina_url)
+
+    sources = []
+    for format in (thumb.get_extra_formats() if crop_name != "original" else []):
+        source_url = get_thumb_url(image, thumb.name, cache_buster, format=format)
+        source_srcset = "%s 1x" % source_url
+        if thumb.retina:
+            source_srcset = "%s, %s 2x" % (
+                source_srcset, get_thumb_url(image, thumb.retina_name, cache_buster, format=format))
+        sources.append({
+            "type": IMAGE_MIME_TYPES.get(format.upper(), 'image/%s' % format),
+            "url": source_url,
+            "srcset": source_srcset,
+        })
+
     return {
-        "url": "%s?%s" % (url, cache_buster),
+        "url": url,
         "width": thumb.width,
         "height": thumb.height,
+        "retina_url": retina_url,
+        "srcset": srcset,
+        "sources": sources,
         "attribution": image.related_object.attribution,
         "attribution_link": image.related_object.attribution_link,
         "caption": image.related_object.caption,
         "alt_text": image.related_object.alt_text,
     }
+
+
+@python_2_unicode_compatible
+class SrcSet(list):
+    """A list of srcset candidates, which renders as a srcset attribute value"""
+
+    def __str__(self):
+        return u', '.join([u'%s %dw' % (c['url'], c['width']) for c in self])
+
+
+@tag_decorator
+def get_crop_srcset(image, crop_name, format=None):
+    """
+    Get all of the widths rendered for a crop, smallest first. Usage:
+
+    {% get_crop_srcset article.image 'main' as srcset %}
+
+    will assign to `srcset` a list of dictionaries that looks like:
+
+    [
+        {"url": '/media/path/to/main_320w.jpg', "width": 320, "height": 240},
+        {"url": '/media/path/to/main_640w.jpg', "width": 640, "height": 480},
+        {"url": '/media/path/to/main.jpg', "width": 1024, "height": 768},
+        {"url": '/media/path/to/main@2x.jpg', "width": 2048, "height": 1536},
+    ]
+
+    which renders as a srcset attribute value, for use like:
+
+        <img src="{{ img.url }}" srcset="{{ srcset }}" sizes="100vw">
+
+    The smaller widths are those passed to the `widths` kwarg of the Size;
+    the @2x version is included for sizes with `retina=True`. Pass `format`
+    (e.g. format='webp') for the URLs of one of the crop's additional formats.
+    """
+    srcset = SrcSet()
+    if not image or not image.related_object:
+        return srcset
+
+    thumbs = image.related_object.get_thumbs_by_name()
+    try:
+        thumb = thumbs[crop_name]
+    except KeyError:
+        return srcset
+
+    if format and format not in thumb.get_extra_formats():
+        return srcset
+    format = format or thumb.format or None
+
+    cache_buster = get_cache_buster(thumb)
+    for width in reversed(thumb.get_widths()):
+        srcset.append({
+            "url": get_thumb_url(image, thumb.get_width_name(width), cache_buster, format=format),
+            "width": width,
+            "height": thumb.get_width_height(width),
+        })
+    srcset.append({
+        "url": get_thumb_url(image, thumb.name, cache_buster, format=format),
+        "width": thumb.width,
+        "height": thumb.height,
+    })
+    if thumb.retina:
+        srcset.append({
+            "url": get_thumb_url(image, thumb.retina_name, cache_buster, format=format),
+            "width": thumb.width * 2,
+            "height": thumb.height * 2,
+        })
+    return srcset
+
+
+def get_cache_buster(thumb):
+    return str(time.mktime(thumb.date_modified.timetuple()))[:-2]
+
+
+def get_thumb_url(image, size_name, cache_buster, format=None):
+    url = getattr(Image.get_file_for_size(image, size_name, format=format), 'url', None)
+    return "%s?%s" % (url, cache_buster)
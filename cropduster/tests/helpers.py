@@ -4,6 +4,8 @@ import uuid
 
 from django.conf import settings
 
+from cropduster.models import Size, Thumb
+
 PATH = os.path.split(__file__)[0]
 ORIG_IMG_PATH = os.path.join(PATH, 'data')
 
@@ -42,3 +44,14 @@ class CropdusterTestCaseMediaMixin(object):
             os.path.join(self.TEST_IMG_DIR, image),
             os.path.join(settings.MEDIA_ROOT, image_name))
         return image_name
+
+    def save_main_thumb(self, image, crop_w=600, crop_h=300, tmp=False, render=True,
+            **size_kwargs):
+        """
+        Saves and returns a 'main' thumb of `image`, cropped from its top
+        left corner, for a 200x100 Size unless `size_kwargs` say otherwise.
+        """
+        size_kwargs.setdefault('w', 200)
+        size_kwargs.setdefault('h', 100)
+        thumb = Thumb(name='main', crop_x=0, crop_y=0, crop_w=crop_w, crop_h=crop_h)
+        return image.save_size(Size('main', **size_kwargs), thumb, tmp=tmp, render=render)['main']
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from .helpers import CropdusterTestCaseMediaMixin
+from .models import Author
+from cropduster.models import Image, Thumb
+
+
+class TestCropdusterCleanup(CropdusterTestCaseMediaMixin, TestCase):
+
+    def save_image(self, author, crop_w=600, tmp=False):
+        image = Image(image=self.create_unique_image('img.jpg'))
+        image.content_type = ContentType.objects.get_for_model(Author)
+        image.object_id = author.pk
+        image.save()
+        thumb = self.save_main_thumb(image, crop_w=crop_w, tmp=tmp)
+        if not tmp:
+            thumb.image = image
+            thumb.save()
+        return image, thumb
+
+    def age(self, *paths):
+        for path in paths:
+            os.utime(path, (0, 0))
+
+    def cleanup(self, *args):
+        stdout = StringIO()
+        call_command('cropduster_cleanup', self.TEST_IMG_DIR_RELATIVE, *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_deletes_old_tmp_files_and_staged_thumbs(self):
+        author = Author.objects.create(name='test')
+        image, thumb = self.save_image(author)
+        staged_image, staged_thumb = self.save_image(author, crop_w=500, tmp=True)
+        tmp_path, = staged_thumb.get_file_paths(staged_image, tmp=True)
+        preview_path = image.save_preview().path
+        thumb_path, = thumb.get_file_paths(image)
+
+        self.assertIn("Deleted 0 files", self.cleanup())
+        self.assertTrue(os.path.exists(tmp_path))
+
+        self.age(tmp_path, preview_path, thumb_path)
+        Thumb.objects.filter(pk=staged_thumb.pk).update(
+            date_modified=timezone.now() - timedelta(days=2))
+        output = self.cleanup('--dry-run')
+        self.assertIn("Would delete 2 files", output)
+        self.assertTrue(os.path.exists(tmp_path))
+
+        self.cleanup()
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertFalse(os.path.exists(preview_path))
+        self.assertTrue(os.path.exists(thumb_path))
+        self.assertFalse(Thumb.objects.filter(pk=staged_thumb.pk).exists())
+        self.assertTrue(Thumb.objects.filter(pk=thumb.pk).exists())
+
+    def test_keeps_files_outside_upload_folders(self):
+        foreign_dir = os.path.join(self.TEST_IMG_DIR, 'foreign')
+        os.makedirs(foreign_dir)
+        foreign_paths = [os.path.join(foreign_dir, name) for name in ('foo_tmp.jpg', '_preview.jpg')]
+        for path in foreign_paths:
+            with open(path, 'wb') as f:
+                f.write(b'not ours')
+        self.age(*foreign_paths)
+
+        self.assertIn("Deleted 0 files", self.cleanup())
+        self.assertTrue(all(os.path.exists(p) for p in foreign_paths))
+
+    def test_deletes_superseded_images(self):
+        author = Author.objects.create(name='test')
+        old_image, old_thumb = self.save_image(author)
+        new_image, new_thumb = self.save_image(author)
+        old_image = Image.objects.get(pk=old_image.pk)
+        self.assertEqual(old_image.prev_object_id, author.pk)
+
+        old_paths = [old_image.image.path] + old_thumb.get_file_paths(old_image)
+        self.age(*old_paths)
+        Image.objects.filter(pk=old_image.pk).update(
+            date_modified=timezone.now() - timedelta(days=2))
+
+        self.cleanup()
+        self.assertTrue(all(os.path.exists(p) for p in old_paths))
+
+        self.cleanup('--superseded')
+        self.assertFalse(Image.objects.filter(pk=old_image.pk).exists())
+        self.assertFalse(any(os.path.exists(p) for p in old_paths))
+        self.assertTrue(os.path.exists(new_image.image.path))
+        self.assertTrue(all(os.path.exists(p) for p in new_thumb.get_file_paths(new_image)))
+
+    def test_deletes_unlinked_deduplicated_originals(self):
+        import uuid
+        from cropduster.utils import deduplicate_file
+        from cropduster.utils.paths import get_deduplicated_path
+
+        md5 = uuid.uuid4().hex
+        path = os.path.join(self.TEST_IMG_DIR, 'img.jpg')
+        deduplicate_file(path, md5)
+        stored_path = get_deduplicated_path(md5, '.jpg')
+        self.age(stored_path)
+        store_dir = os.path.relpath(os.path.dirname(stored_path), settings.MEDIA_ROOT)
+
+        call_command('cropduster_cleanup', store_dir, stdout=StringIO())
+        self.assertTrue(os.path.exists(stored_path))
+
+        os.unlink(path)
+        call_command('cropduster_cleanup', store_dir, stdout=StringIO())
+        self.assertFalse(os.path.exists(stored_path))
@@ -2,7 +2,9 @@ from __future__ import absolute_import, division
 
 import os
 import PIL
+from unittest import skipUnless
 
+from django.db import connection
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
 from django.utils.six.moves import range
@@ -12,7 +14,7 @@ from .models import (
     Article, Author, TestForOptionalSizes, TestMultipleFieldsInheritanceChild,
     TestReverseForeignRelA, TestReverseForeignRelB, TestReverseForeignRelC,
     TestReverseForeignRelM2M)
-from cropduster.models import Size, Image
+from cropduster.models import Size, Image, StandaloneImage, Thumb
 from cropduster.exceptions import CropDusterResizeException
 
 
@@ -62,6 +64,76 @@ class TestImage(CropdusterTestCaseMediaMixin, TestCase):
             title="Img Too Small", author=self.author, lead_image=new_image_path)
         self.assertRaises(CropDusterResizeException, article.lead_image.generate_thumbs)
 
+    def test_generate_thumbs_skips_unchanged(self):
+        article = self.article
+        thumbs = list(article.lead_image.related_object.thumbs.all())
+        self.assertTrue(all(thumb.fingerprint for thumb in thumbs))
+        for thumb in thumbs:
+            os.utime(thumb.path, (0, 0))
+
+        main = article.lead_image.related_object.thumbs.get(name='main')
+        os.unlink(main.path)
+
+        article.lead_image.generate_thumbs()
+        for thumb in thumbs:
+            if thumb.name == 'main':
+                self.assertNotEqual(os.stat(thumb.path).st_mtime, 0)
+            else:
+                self.assertEqual(os.stat(thumb.path).st_mtime, 0)
+
+    def test_unset_and_set_as_auto_crop(self):
+        from cropduster.utils import set_as_auto_crop, unset_as_auto_crop
+
+        image = self.article.lead_image.related_object
+        main = image.thumbs.get(name='main')
+        thumb = image.thumbs.get(name='thumb')
+        self.assertEqual(thumb.reference_thumb_id, main.pk)
+
+        unset_as_auto_crop(thumb)
+        thumb = Thumb.objects.get(pk=thumb.pk)
+        self.assertIsNone(thumb.reference_thumb_id)
+        best_fit = Size('thumb', w=110, h=90).fit_to_crop(main)
+        self.assertEqual(thumb.get_crop_box(), best_fit.box)
+
+        set_as_auto_crop(thumb, main)
+        thumb = Thumb.objects.get(pk=thumb.pk)
+        self.assertEqual(thumb.reference_thumb_id, main.pk)
+        self.assertIsNone(thumb.crop_w)
+
+    def test_get_crop_srcset(self):
+        from cropduster.templatetags.cropduster_tags import get_crop_srcset
+
+        srcset = get_crop_srcset(self.article.lead_image, 'main')
+        self.assertEqual([c['width'] for c in srcset], [600])
+        self.assertEqual(str(srcset), '%s 600w' % srcset[0]['url'])
+        self.assertEqual(get_crop_srcset(self.article.lead_image, 'missing'), [])
+
+    def test_thumb_lookups(self):
+        image = Image.objects.get(pk=self.article.lead_image.related_object.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(image.get_thumbs_by_name()), ['main', 'no_height', 'thumb'])
+        with self.assertNumQueries(1):
+            self.assertEqual(image.get_image_filename('main'), 'main.jpg')
+        self.assertFalse(image.has_thumb('missing'))
+        self.assertEqual(image.get_image_size('thumb'), (110, 90))
+        self.assertGreater(image.get_image_filesize('thumb'), 0)
+
+        Thumb.objects.filter(image=image, name='thumb').update(width=100)
+        self.assertEqual(image.get_image_size('thumb')[0], 100)
+
+        image.thumbs.all().delete()
+        self.assertFalse(image.has_thumb('main'))
+        self.assertEqual(image.get_thumbs_by_name(), {})
+
+    def test_thumb_lookups_use_prefetched_thumbs(self):
+        image_pk = self.article.lead_image.related_object.pk
+        prefetched = Image.objects.prefetch_related('thumbs').get(pk=image_pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(prefetched.has_thumb('main'))
+            self.assertFalse(prefetched.has_thumb('missing'))
+            self.assertEqual(prefetched.get_image_size('thumb'), (110, 90))
+            self.assertEqual(prefetched.get_image_filename('main'), 'main.jpg')
+
     def test_prefetch_related_with_images(self):
         for x in range(3):
             lead_image = self.create_unique_image('img.jpg')
@@ -301,12 +373,222 @@ class TestModelSaving(CropdusterTestCaseMediaMixin, TestCase):
         num_thumbs = len(image.thumbs.all())
         self.assertEqual(num_thumbs, 2, "Expected one thumb; instead got %d" % num_thumbs)
 
+    def test_staged_thumb_without_files_renders_on_save(self):
+        img_path = self.create_unique_image('img.jpg')
+        image = Image(image=img_path)
+        thumb = self.save_main_thumb(image, tmp=True, render=False)
+        tmp_path = Image.get_file_for_size(image.image, 'main', tmp=True).path
+        self.assertFalse(os.path.exists(tmp_path))
+
+        author = Author.objects.create(name='test')
+        image.content_type = ContentType.objects.get_for_model(Author)
+        image.object_id = author.pk
+        image.save()
+        thumb = Thumb.objects.get(pk=thumb.pk)
+        thumb.image = image
+        thumb.save()
+
+        thumb_path = Image.get_file_for_size(image.image, 'main').path
+        self.assertTrue(os.path.exists(thumb_path))
+        self.assertEqual(PIL.Image.open(thumb_path).size, (200, 100))
+
+    def test_staged_thumb_render_error_is_raised(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+        thumb = self.save_main_thumb(image, tmp=True, render=False)
+        author = Author.objects.create(name='test')
+        image.content_type = ContentType.objects.get_for_model(Author)
+        image.object_id = author.pk
+        image.save()
+        os.remove(image.image.path)
+
+        thumb = Thumb.objects.get(pk=thumb.pk)
+        thumb.image = image
+        with self.assertRaises(IOError):
+            thumb.save()
+        self.assertTrue(Thumb.objects.get(pk=thumb.pk).is_staged)
+
+    def test_save_form_data_promotes_staged_thumbs(self):
+        author = Author.objects.create(name='test')
+        image = Image.objects.create(image=self.create_unique_image('img.jpg'),
+            content_type=ContentType.objects.get_for_model(Author), object_id=author.pk)
+        saved_thumb = self.save_main_thumb(image)
+        saved_thumb.image = image
+        saved_thumb.save()
+        staged_thumb = self.save_main_thumb(image, tmp=True, render=False)
+        staged_thumb.name = 'staged'
+        staged_thumb.save()
+
+        Image._meta.get_field('thumbs').save_form_data(image, [saved_thumb, staged_thumb])
+        self.assertEqual(sorted(image.get_thumbs_by_name()), ['main', 'staged'])
+        self.assertTrue(os.path.exists(image.get_image_path('staged')))
+
+    def test_staged_thumb_promoted_once(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+        thumb = self.save_main_thumb(image, tmp=True)
+        self.assertTrue(thumb.is_staged)
+        tmp_path, = thumb.get_file_paths(image, tmp=True)
+        path, = thumb.get_file_paths(image)
+        self.assertTrue(os.path.exists(tmp_path))
+
+        author = Author.objects.create(name='test')
+        image.content_type = ContentType.objects.get_for_model(Author)
+        image.object_id = author.pk
+        image.save()
+        thumb.image = image
+        thumb.save()
+        self.assertFalse(thumb.is_staged)
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertTrue(os.path.exists(path))
+
+        # Saving the thumb again does not promote files again
+        with open(tmp_path, 'wb') as f:
+            f.write(b'stale')
+        Thumb.objects.get(pk=thumb.pk).save()
+        self.assertTrue(os.path.exists(tmp_path))
+        self.assertEqual(PIL.Image.open(path).size, (200, 100))
+
+    def test_save_size_retina(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+
+        thumb = self.save_main_thumb(image, retina=True)
+        self.assertTrue(thumb.retina)
+        self.assertEqual(thumb.file_names, ['main', 'main@2x'])
+        self.assertEqual(PIL.Image.open(image.get_image_path('main')).size, (200, 100))
+        self.assertEqual(PIL.Image.open(image.get_image_path('main@2x')).size, (400, 200))
+
+        # Crops without enough pixels for a 2x version only get a 1x
+        thumb = self.save_main_thumb(image, crop_w=300, crop_h=150, retina=True)
+        self.assertFalse(thumb.retina)
+        self.assertEqual(thumb.file_names, ['main'])
+
+    def test_save_size_widths(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+
+        thumb = self.save_main_thumb(image, w=400, h=200, retina=True, widths=[100, 800, 200])
+        self.assertFalse(thumb.retina)
+        self.assertEqual(thumb.get_widths(), [200, 100])
+        self.assertEqual(thumb.file_names, ['main', 'main_200w', 'main_100w'])
+        for name, dimensions in [('main', (400, 200)), ('main_200w', (200, 100)), ('main_100w', (100, 50))]:
+            self.assertEqual(PIL.Image.open(image.get_image_path(name)).size, dimensions)
+
+    def test_save_size_formats(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+
+        thumb = self.save_main_thumb(image, retina=True, formats=['PNG', 'jpeg', 'nosuchformat'])
+        self.assertEqual(thumb.get_extra_formats(), ['png'])
+        png_path = image.get_image_path('main@2x', format='png')
+        self.assertTrue(png_path.endswith('main@2x.png'))
+        self.assertEqual(PIL.Image.open(png_path).size, (400, 200))
+        self.assertEqual(PIL.Image.open(image.get_image_path('main', format='png')).size, (200, 100))
+        self.assertEqual(len(thumb.get_file_paths(image)), 4)
+        self.assertTrue(all(os.path.exists(p) for p in thumb.get_file_paths(image)))
+
+    def test_save_size_convert_png(self):
+        from cropduster.utils import image as image_utils
+
+        convert_png_format = image_utils.CROPDUSTER_CONVERT_PNG_FORMAT
+        image_utils.CROPDUSTER_CONVERT_PNG_FORMAT = 'jpeg'
+        try:
+            image = Image(image=self.create_unique_image('img.png'))
+            thumb = self.save_main_thumb(image)
+            self.assertEqual(thumb.format, 'jpeg')
+            self.assertEqual(thumb.extension, '.jpg')
+            self.assertTrue(thumb.get_file_paths(image)[0].endswith('main.jpg'))
+            self.assertEqual(PIL.Image.open(thumb.get_file_paths(image)[0]).format, 'JPEG')
+
+            # PNGs with transparency stay PNGs
+            image = Image(image=self.create_unique_image('transparent.png'))
+            thumb = self.save_main_thumb(image, crop_w=160, crop_h=80, w=80, h=40)
+            self.assertEqual(thumb.format, '')
+            self.assertEqual(PIL.Image.open(image.get_image_path('main')).format, 'PNG')
+        finally:
+            image_utils.CROPDUSTER_CONVERT_PNG_FORMAT = convert_png_format
+
+    def test_save_size_profile(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        image = Image(image=self.create_unique_image('img.jpg'))
+        thumb = self.save_main_thumb(image, profile='small')
+        self.assertEqual(thumb.profile, 'small')
+        self.assertIn('progressive', PIL.Image.open(image.get_image_path('main')).info)
+
+        with self.assertRaises(ImproperlyConfigured):
+            self.save_main_thumb(image, profile='nosuchprofile')
+
+    def test_save_size_max_bytes(self):
+        image = Image(image=self.create_unique_image('img.jpg'))
+        self.save_main_thumb(image, w=300, h=150, retina=True)
+        unbudgeted_size = os.path.getsize(image.get_image_path('main'))
+
+        max_bytes = unbudgeted_size * 2 // 3
+        thumb = self.save_main_thumb(image, w=300, h=150, retina=True, max_bytes=max_bytes)
+        self.assertEqual(thumb.max_bytes, max_bytes)
+        self.assertLessEqual(os.path.getsize(image.get_image_path('main')), max_bytes)
+        # The budget of the @2x version is scaled by its area
+        self.assertLessEqual(os.path.getsize(image.get_image_path('main@2x')), max_bytes * 4)
+
     def test_multiple_fields_with_inheritance(self):
         child_fields = [f.name for f in TestMultipleFieldsInheritanceChild._meta.local_fields]
         self.assertNotIn('image', child_fields,
             "Field 'image' from parent model should not be in the child model's local_fields")
 
 
+class TestStandaloneImage(CropdusterTestCaseMediaMixin, TestCase):
+
+    def test_save_stores_hex_md5(self):
+        import hashlib
+
+        image_name = self.create_unique_image('img.jpg')
+        with open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        standalone = StandaloneImage(image=image_name)
+        standalone.save()
+        self.assertEqual(standalone.md5, md5)
+
+    def test_get_by_md5(self):
+        md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+        standalone = StandaloneImage.objects.create(md5=md5)
+        self.assertEqual(StandaloneImage.objects.get_by_md5(md5.upper()).pk, standalone.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(StandaloneImage.objects.get_by_md5(md5).pk, standalone.pk)
+        standalone.delete()
+        with self.assertRaises(StandaloneImage.DoesNotExist):
+            StandaloneImage.objects.get_by_md5(md5)
+        with self.assertRaises(StandaloneImage.DoesNotExist):
+            StandaloneImage.objects.get_by_md5(None)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Query plans are checked with SQLite")
+class TestQueryPlans(TestCase):
+    """
+    Checks that the queries cropduster makes for every image it renders
+    are answered from an index (a SQLite SEARCH) rather than by scanning
+    the table. To review a plan by hand, run ``EXPLAIN QUERY PLAN`` (or
+    ``EXPLAIN`` on other databases) on the SQL of the querysets below.
+    """
+
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            details = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(details)
+        for detail in details:
+            self.assertTrue(detail.startswith('SEARCH') and 'INDEX' in detail,
+                "Query does not use an index: %s (%s)" % (sql, detail))
+
+    def test_image_lookups_use_index(self):
+        ct = ContentType.objects.get_for_model(Article)
+        self.assertUsesIndex(Image.objects.filter(
+            content_type=ct, object_id=1, field_identifier='', prev_object_id__isnull=True))
+        self.assertUsesIndex(Image.objects.filter(content_type=ct, object_id__in=[1, 2]))
+        self.assertUsesIndex(Image.objects.filter(content_type=ct, prev_object_id=1))
+
+    def test_thumb_lookup_uses_index(self):
+        self.assertUsesIndex(Thumb.objects.filter(image_id=1, name='main'))
+        self.assertUsesIndex(Thumb.objects.filter(image_id__in=[1, 2]))
+
+
 class TestReverseForeignRelation(TestCase):
 
     def test_standard_manager(self):
@@ -1,8 +1,10 @@
 import os
+from unittest import skipUnless
 
 from django import test
 
 from .helpers import CropdusterTestCaseMediaMixin
+from cropduster import resizing
 from cropduster.resizing import Crop, Box, Size
 
 
@@ -23,3 +25,45 @@ class TestResizing(CropdusterTestCaseMediaMixin, test.TestCase):
         new_crop = size.fit_to_crop(crop)
         self.assertGreaterEqual(new_crop.box.w, 650,
             "Calculated best fit (%d) didn't get required width (650)" % new_crop.box.w)
+
+    def best_fit_many_cases(self):
+        sizes = [
+            Size('960', w=960, h=594),
+            Size('650', w=650, min_h=250),
+            Size('square', w=300, h=300),
+            Size('tall', w=200, h=900),
+            Size('wide', w=1200, h=200),
+            Size('free', min_w=100, min_h=100, max_w=2000),
+            Size('narrow', h=400, max_w=300),
+        ]
+        boxes = [
+            Box(x1=0, y1=0, x2=960, y2=915),
+            Box(x1=160, y1=0, x2=800, y2=640),
+            Box(x1=13, y1=27, x2=455, y2=301),
+        ]
+        for box in boxes:
+            crop = Crop(box, (960, 915))
+            expected = [size.fit_to_crop(crop).box for size in sizes]
+            yield crop, sizes, expected
+
+    def test_best_fit_many(self):
+        numpy, resizing.numpy = resizing.numpy, None
+        try:
+            for crop, sizes, expected in self.best_fit_many_cases():
+                self.assertEqual([c.box for c in crop.best_fit_many(sizes)], expected)
+        finally:
+            resizing.numpy = numpy
+
+    @skipUnless(resizing.numpy, "numpy is not installed")
+    def test_best_fit_many_numpy(self):
+        for crop, sizes, expected in self.best_fit_many_cases():
+            self.assertEqual([c.box for c in crop.best_fit_many(sizes)], expected)
+
+    def test_box_is_immutable_and_hashable(self):
+        box = Box(10, 20, 110, 70)
+        self.assertEqual(hash(box), hash(Box(10, 20, 110, 70)))
+        self.assertEqual(len(set([box, Box(10, 20, 110, 70), Box(0, 0, 1, 1)])), 2)
+        with self.assertRaises(AttributeError):
+            box.x1 = 0
+        with self.assertRaises(AttributeError):
+            box.foo = 'bar'
@@ -59,6 +59,19 @@ class TestUtilsImage(CropdusterTestCaseMediaMixin, test.TestCase):
         self.assertTrue(is_animated_gif(yes))
         self.assertFalse(is_animated_gif(no))
 
+    def test_process_image_quality_within_max_bytes(self):
+        from ..utils import process_image
+
+        im = self._get_img('img.jpg')
+        path = os.path.join(self.TEST_IMG_DIR, 'budget.jpg')
+        process_image(im, path, save_params={'quality': 95})
+        unbudgeted_size = os.path.getsize(path)
+
+        max_bytes = unbudgeted_size // 2
+        process_image(self._get_img('img.jpg'), path, save_params={'quality': 95},
+            max_bytes=max_bytes)
+        self.assertLessEqual(os.path.getsize(path), max_bytes)
+
 
 class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
 
@@ -70,10 +83,55 @@ class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
         path = os.path.join(settings.MEDIA_ROOT, random)
         self.assertEqual(get_upload_foldername('my img.jpg', upload_to=random),
                          os.path.join(path, 'my_img'))
-        self.assertEqual(get_upload_foldername('my img.jpg', upload_to=random),
-                         os.path.join(path, 'my_img-1'))
+        # Collisions get a random suffix
+        folders = set([get_upload_foldername('my img.jpg', upload_to=random) for i in range(3)])
+        self.assertEqual(len(folders), 3)
+        for folder in folders:
+            self.assertRegexpMatches(folder, r'^%s-[0-9a-f]{6}$' % os.path.join(path, 'my_img'))
+            self.assertTrue(os.path.isdir(folder))
         shutil.rmtree(path)
 
+    def test_deduplicate_file(self):
+        import uuid
+        from ..utils import deduplicate_file
+        from ..utils.paths import get_deduplicated_path
+
+        md5 = uuid.uuid4().hex
+        paths = [os.path.join(self.TEST_IMG_DIR, 'copy%d.jpg' % i) for i in range(2)]
+        for path in paths:
+            shutil.copyfile(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), path)
+        stored_path = get_deduplicated_path(md5, '.jpg')
+        try:
+            self.assertFalse(deduplicate_file(paths[0], md5))
+            self.assertTrue(deduplicate_file(paths[1], md5))
+            self.assertEqual(os.stat(stored_path).st_nlink, 3)
+            self.assertTrue(os.path.samefile(paths[0], paths[1]))
+        finally:
+            os.unlink(stored_path)
+
+    def test_get_file_md5(self):
+        import hashlib
+        from ..utils import get_file_md5
+
+        path = os.path.join(self.TEST_IMG_DIR, 'hashed.jpg')
+        shutil.copyfile(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), path)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        self.assertEqual(get_file_md5(path), hashlib.md5(contents).hexdigest())
+        # A changed file is hashed again
+        with open(path, 'ab') as f:
+            f.write(b'\0')
+        self.assertEqual(get_file_md5(path), hashlib.md5(contents + b'\0').hexdigest())
+
+    def test_virtual_field_file_image_info(self):
+        from ..files import VirtualFieldFile
+
+        image_file = VirtualFieldFile(os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        self.assertEqual(image_file.image_info, ((674, 800), 'JPEG'))
+        self.assertEqual(image_file.dimensions, (674, 800))
+        self.assertEqual(image_file.image_format, 'JPEG')
+        self.assertEqual(VirtualFieldFile('missing.jpg').dimensions, (0, 0))
+
     def test_get_min_size(self):
         from ..utils import get_min_size
         from ..resizing import Size
@@ -99,3 +157,169 @@ class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
         from_url = settings.MEDIA_URL + img_name
         to_url = settings.MEDIA_ROOT + img_name
         self.assertEqual(get_media_path(from_url), to_url)
+
+
+class TestUtilsJson(test.TestCase):
+
+    def test_loads_sizes_interns_sizes(self):
+        from ..utils import json
+        from ..resizing import Size
+
+        sizes_json = json.dumps([
+            Size('main', w=600, h=480, auto=[Size('thumb', w=110, h=90)]),
+            Size('no_height', w=600),
+        ])
+        sizes = json.loads_sizes(sizes_json)
+        self.assertEqual([s.name for s in Size.flatten(sizes)], ['main', 'thumb', 'no_height'])
+        self.assertIs(sizes[0].auto[0].parent, sizes[0])
+
+        sizes_again = json.loads_sizes(sizes_json)
+        self.assertIsNot(sizes_again, sizes)
+        self.assertIs(sizes_again[0], sizes[0])
+        self.assertIs(sizes_again[1], sizes[1])
+
+        size_json = json.dumps(Size('main', w=600, h=480))
+        self.assertIs(json.loads_sizes(size_json), json.loads_sizes(size_json))
+        self.assertIsNone(json.loads_sizes('null'))
+
+    def test_loaded_sizes_are_frozen(self):
+        import copy
+        from ..utils import json
+        from ..resizing import Size
+
+        size = json.loads_sizes(json.dumps(Size('main', w=600, h=480, auto=[
+            Size('thumb', w=110, h=90)])))
+        self.assertTrue(size.is_frozen)
+        self.assertTrue(size.auto[0].is_frozen)
+        with self.assertRaises(AttributeError):
+            size.width = 100
+        self.assertIs(copy.deepcopy(size), size)
+
+    def test_dumps_sizes(self):
+        from ..utils import json
+        from ..resizing import Size
+
+        sizes = [Size('main', w=600, h=480, auto=[Size('thumb', w=110, h=90)]), Size('wide', w=600)]
+        expected = json.dumps(sizes, default=json.json_default)
+        self.assertEqual(json.dumps(sizes), expected)
+        frozen_sizes = json.loads_sizes(expected)
+        self.assertEqual(json.dumps(frozen_sizes), expected)
+        self.assertEqual(json.dumps(frozen_sizes), expected)
+        self.assertEqual(json.dumps(frozen_sizes[0]), json.dumps(sizes[0], default=json.json_default))
+
+
+class TestUtilsCache(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_lru_cache(self):
+        from ..utils.cache import LRUCache
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('b', LRUCache.missing), LRUCache.missing)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_file_cache_key(self):
+        from ..utils.cache import file_cache_key
+
+        img_path = os.path.join(self.TEST_IMG_DIR, 'img.jpg')
+        key = file_cache_key(img_path)
+        self.assertEqual(file_cache_key(img_path), key)
+        with open(img_path, 'ab') as f:
+            f.write(b'\0')
+        self.assertNotEqual(file_cache_key(img_path), key)
+
+
+class TestRemoteFetch(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestRemoteFetch, self).setUp()
+        import threading
+        from django.utils.six.moves import BaseHTTPServer, socketserver
+
+        with open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), 'rb') as f:
+            image_contents = f.read()
+        self.image_contents = image_contents
+        self.requests = requests = []
+        self.connections = connections = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                requests.append(self.path)
+                if self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', '/img.jpg')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                elif self.path == '/img.jpg':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(image_contents)))
+                    self.end_headers()
+                    self.wfile.write(image_contents)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        from ..utils.remote import pool
+
+        pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestRemoteFetch, self).tearDown()
+
+    def test_fetch_url_reuses_connections(self):
+        import hashlib
+        from ..utils.remote import fetch_url
+
+        for i in range(2):
+            f, md5 = fetch_url(self.base_url + '/redirect')
+            with f:
+                self.assertEqual(f.read(), self.image_contents)
+            self.assertEqual(md5, hashlib.md5(self.image_contents).hexdigest())
+        self.assertEqual(self.requests, ['/redirect', '/img.jpg'] * 2)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_fetch_url_errors(self):
+        from ..exceptions import CropDusterUrlException
+        from ..utils.remote import fetch_url
+
+        with self.assertRaises(CropDusterUrlException):
+            fetch_url(self.base_url + '/img.jpg', max_bytes=1024)
+        with self.assertRaises(CropDusterUrlException):
+            fetch_url(self.base_url + '/missing.jpg')
+        with self.assertRaises(CropDusterUrlException):
+            fetch_url('ftp://127.0.0.1/img.jpg')
+
+    def test_download_image_url_is_cached(self):
+        from ..files import ImageFile
+
+        url = self.base_url + '/img.jpg'
+        image_file = ImageFile(url, upload_to=self.TEST_IMG_DIR_RELATIVE)
+        self.assertTrue(image_file.name.startswith(self.TEST_IMG_DIR_RELATIVE))
+        self.assertEqual(image_file.dimensions, (674, 800))
+        self.assertEqual(ImageFile(url).name, image_file.name)
+        self.assertEqual(self.requests, ['/img.jpg'])
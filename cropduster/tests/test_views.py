@@ -11,9 +11,11 @@ from django.http import HttpRequest
 from generic_plus.utils import get_media_path
 
 from cropduster import views
+from cropduster.models import Image, Size, Thumb
 from cropduster.utils import json
 
 from .helpers import CropdusterTestCaseMediaMixin
+from .models import Article, Author
 
 
 class CropdusterViewTestRunner(CropdusterTestCaseMediaMixin, test.TestCase):
@@ -114,3 +116,75 @@ class TestUpload(CropdusterViewTestRunner):
 
         self.assertEqual(response.status_code, 200)
         self.assertTrue(os.path.exists(uploaded_img_path))
+
+
+class TestCropClientSidePreview(CropdusterViewTestRunner):
+
+    def setUp(self):
+        super(TestCropClientSidePreview, self).setUp()
+        self.client_side_preview = views.CLIENT_SIDE_PREVIEW
+        views.CLIENT_SIDE_PREVIEW = True
+        self.image_name = self.create_unique_image('img.jpg')
+        self.size = Size('main', w=200, h=100)
+
+    def tearDown(self):
+        views.CLIENT_SIDE_PREVIEW = self.client_side_preview
+        super(TestCropClientSidePreview, self).tearDown()
+
+    def post_crop(self, thumb=None, crop_thumbs=None, **extra):
+        thumb = thumb or Thumb(name='main', width=200, height=100,
+            crop_x=0, crop_y=0, crop_w=600, crop_h=300)
+        data = {
+            u'crop-orig_image': self.image_name,
+            u'crop-orig_w': u'674',
+            u'crop-orig_h': u'800',
+            u'crop-sizes': json.dumps([self.size]),
+            u'crop-thumbs': json.dumps(crop_thumbs or {}),
+            u'thumbs-TOTAL_FORMS': u'1',
+            u'thumbs-INITIAL_FORMS': u'1' if thumb.pk else u'0',
+            u'thumbs-MIN_NUM_FORMS': u'0',
+            u'thumbs-MAX_NUM_FORMS': u'1000',
+            u'thumbs-0-id': thumb.pk or u'',
+            u'thumbs-0-size': json.dumps(self.size),
+            u'thumbs-0-thumbs': u'{}',
+        }
+        for field in ('name', 'width', 'height', 'crop_x', 'crop_y', 'crop_w', 'crop_h'):
+            data[u'thumbs-0-%s' % field] = getattr(thumb, field)
+        data.update(extra)
+        request = self.factory.post(reverse('cropduster-crop'), data)
+        request.user = self.user
+        response = views.crop(request)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_crop_is_not_rendered(self):
+        data = self.post_crop()
+        tmp_path = Image(image=self.image_name).get_image_path('main', tmp=True)
+
+        self.assertTrue(data['crop']['client_side_preview'])
+        self.assertEqual(data['crop']['thumbs']['main']['crop_box'], [0, 0, 600, 300])
+        self.assertTrue(data['thumbs'][0]['changed'])
+        self.assertFalse(os.path.exists(tmp_path))
+
+    def test_server_preview_renders_staged_thumbs(self):
+        thumb = Thumb.objects.get(pk=self.post_crop()['thumbs'][0]['id'])
+        data = self.post_crop(thumb, **{u'crop-server_preview': u'on'})
+        tmp_path = Image(image=self.image_name).get_image_path('main', tmp=True)
+
+        self.assertNotIn('client_side_preview', data['crop'])
+        self.assertNotIn('crop_box', data['crop']['thumbs']['main'])
+        self.assertTrue(os.path.exists(tmp_path))
+
+    def test_unchanged_saved_thumb_is_not_tmp(self):
+        author = Author.objects.create(name="Samuel Langhorne Clemens")
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=author, lead_image=self.image_name)
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        thumb = article.lead_image.related_object.thumbs.get(name='main')
+        data = self.post_crop(thumb, crop_thumbs={
+            'main': {'id': thumb.pk, 'name': 'main'},
+        })
+
+        self.assertIs(data['crop']['thumbs']['main']['tmp_file'], False)
+        self.assertNotIn('crop_box', data['crop']['thumbs']['main'])
@@ -1,8 +1,9 @@
 from .image import (
     get_image_extension, is_transparent, exif_orientation,
-    correct_colorspace, is_animated_gif, has_animated_gif_support, process_image,
-    smart_resize)
-from .paths import get_upload_foldername
+    correct_colorspace, is_animated_gif, has_animated_gif_support, is_format_supported,
+    is_photographic, is_opaque, get_thumb_format, process_image, smart_resize)
+from .hashing import get_file_md5
+from .paths import get_upload_foldername, deduplicate_file
 from .sizes import get_min_size
 from .thumbs import set_as_auto_crop, unset_as_auto_crop
 from . import jsonutils as json
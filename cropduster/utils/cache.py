@@ -0,0 +1,55 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+__all__ = ('LRUCache', 'file_cache_key')
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-process cache which holds at most `max_size` entries,
+    discarding the least recently used ones first.
+    """
+
+    missing = object()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for `key`, or `default` if there is none.
+        Pass LRUCache.missing as the default to be able to cache None.
+        """
+        with self._lock:
+            value = self._data.pop(key, self.missing)
+            if value is self.missing:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def file_cache_key(path):
+    """
+    Returns a key for values computed from the contents of the file at
+    `path`, which changes whenever the file is replaced or modified.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_ino, stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime))
@@ -0,0 +1,43 @@
+import hashlib
+
+from .cache import LRUCache, file_cache_key
+
+
+__all__ = ('get_md5', 'get_file_md5')
+
+
+# Number of bytes read at a time when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of file digests to remember
+FILE_MD5_CACHE_MAX = 128
+
+_file_md5s = LRUCache(FILE_MD5_CACHE_MAX)
+
+
+def get_md5(f, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Returns the hex md5 digest of the rest of the contents of file object
+    `f`, reading it `chunk_size` bytes at a time.
+    """
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_file_md5(path):
+    """
+    Returns the hex md5 digest of the file at `path`.
+
+    Digests are remembered for as long as the file's inode, size and
+    modification time stay the same, so that the original image is read
+    only once when all of its crops are saved.
+    """
+    key = file_cache_key(path)
+    digest = _file_md5s.get(key)
+    if digest is None:
+        with open(path, mode='rb') as f:
+            digest = get_md5(f)
+        _file_md5s.set(key, digest)
+    return digest
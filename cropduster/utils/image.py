@@ -1,6 +1,7 @@
 from __future__ import division
 
 import os
+import io
 import tempfile
 import warnings
 import math
@@ -22,7 +23,9 @@ from django.utils import six
 from django.utils.six.moves import xrange
 
 from cropduster.settings import (
-    get_jpeg_quality, JPEG_SAVE_ICC_SUPPORTED, CROPDUSTER_GIFSICLE_PATH)
+    get_jpeg_quality, get_encoder_params, JPEG_SAVE_ICC_SUPPORTED, CROPDUSTER_GIFSICLE_PATH,
+    CROPDUSTER_CONVERT_PNG_FORMAT, CROPDUSTER_CONVERT_PNG_MIN_COLORS,
+    CROPDUSTER_MIN_JPEG_QUALITY)
 
 from .images2gif import read_gif, write_gif
 from .gifsicle import GifsicleImage
@@ -31,9 +34,15 @@ from .gifsicle import GifsicleImage
 __all__ = (
     'get_image_extension', 'is_transparent', 'exif_orientation',
     'correct_colorspace', 'is_animated_gif', 'has_animated_gif_support',
+    'is_format_supported', 'is_photographic', 'is_opaque', 'get_thumb_format',
     'process_image', 'smart_resize')
 
 
+# Bump when changes to rendering alter the files of existing thumbnails, so
+# that they are re-rendered rather than skipped as unchanged
+RENDER_VERSION = 1
+
+
 IMAGE_EXTENSIONS = {
     "ARG":  ".arg",   "BMP":  ".bmp",   "BUFR": ".bufr",  "CUR":  ".cur",   "DCX":  ".dcx",
     "EPS":  ".ps",    "FITS": ".fit",   "FLI":  ".fli",   "FPX":  ".fpx",   "GBR":  ".gbr",
@@ -42,6 +51,13 @@ IMAGE_EXTENSIONS = {
     "MSP":  ".msp",   "Palm": ".palm",  "PCD":  ".pcd",   "PCX":  ".pcx",   "PDF":  ".pdf",
     "PNG":  ".png",   "PPM":  ".ppm",   "PSD":  ".psd",   "SGI":  ".rgb",   "SUN":  ".ras",
     "TGA":  ".tga",   "TIFF": ".tiff",  "WMF":  ".wmf",   "XBM":  ".xbm",   "XPM":  ".xpm",
+    "WEBP": ".webp",  "AVIF": ".avif",
+}
+
+# Mime types of the formats that crops can additionally be rendered in
+IMAGE_MIME_TYPES = {
+    "WEBP": "image/webp",
+    "AVIF": "image/avif",
 }
 
 
@@ -126,7 +142,38 @@ def has_animated_gif_support():
     return bool(CROPDUSTER_GIFSICLE_PATH or (numpy and scipy))
 
 
-def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None):
+def is_format_supported(format):
+    """Whether this build of PIL can save images in `format` (e.g. 'webp')."""
+    PIL.Image.init()
+    return format.upper() in PIL.Image.SAVE
+
+
+def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None,
+        derivatives=None, format=None, formats=None, profile=None, max_bytes=None):
+    """
+    Applies `callback` to the image (or to each frame of an animated gif)
+    and, if `save_filename` is given, saves the result to that path.
+
+    `derivatives` is an optional list of (save_filename, callback) pairs
+    which are rendered in the same pass. Each derivative callback is applied
+    to the output of the previous step, so that, for instance, a 1x
+    thumbnail can be resampled from its 2x rendition rather than from the
+    original image.
+
+    `format` is the format to save in, if not that of the source image.
+    `formats` is an optional list of additional formats (e.g. ['webp']) in
+    which each output is also saved, from the same pixels, next to the
+    file in the primary format. Both are ignored for animated gifs.
+
+    `profile` names the encoder profile (see CROPDUSTER_ENCODER_PROFILES)
+    whose parameters, e.g. progressive or compress_level, are used to save
+    each format; `save_params` take precedence over them.
+
+    `max_bytes` is an optional byte budget for each lossy output, either a
+    number or a callable which takes the width and height of the output and
+    returns one. The highest quality (down to CROPDUSTER_MIN_JPEG_QUALITY)
+    whose encoding fits the budget is used.
+    """
     is_animated = is_animated_gif(im)
     images = [im]
 
@@ -160,28 +207,167 @@ def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_param
     if is_animated and not save_filename:
         raise Exception("Animated gifs must be saved on each processing.")
 
+    if derivatives and not save_filename:
+        raise Exception("Derivatives can only be generated when saving the image.")
+
     if save_filename:
         # Only true if animated gif supported and multiple frames in image
-        if is_animated and len(images) > 1:
-            duration_ms = im.info.get('duration') or 100
-            duration = float(duration_ms) / 1000.0
-            repeat = True
-            if im.info.get('loop', 0) != 0:
-                repeat = im.info['loop']
-            write_gif(save_filename, new_images, duration=duration, repeat=repeat, nq=nq, dispose=dispose)
-        else:
-            save_params = save_params or {}
-            if im.format == 'JPEG':
-                save_params.setdefault('quality', get_jpeg_quality(new_images[0].size[0], new_images[0].size[1]))
-            if im.format in ('JPEG', 'PNG') and JPEG_SAVE_ICC_SUPPORTED:
-                save_params.setdefault('icc_profile', im.info.get('icc_profile'))
-            new_images[0].save(save_filename, **save_params)
+        is_multiframe = is_animated and len(images) > 1
+        if is_animated:
+            format, formats = None, None
+        _save_frames(im, new_images, save_filename, is_multiframe, nq=nq,
+            dispose=dispose, save_params=save_params, format=format, formats=formats,
+            profile=profile, max_bytes=max_bytes)
+        for derivative_filename, derivative_callback in (derivatives or []):
+            new_images = [derivative_callback(i) for i in new_images]
+            _save_frames(im, new_images, derivative_filename, is_multiframe, nq=nq,
+                dispose=dispose, save_params=save_params, format=format, formats=formats,
+                profile=profile, max_bytes=max_bytes)
 
         return PIL.Image.open(save_filename)
 
     return new_images[0]
 
 
+def _save_frames(im, frames, save_filename, is_multiframe=False, nq=0, dispose=None,
+        save_params=None, format=None, formats=None, profile=None, max_bytes=None):
+    """
+    Saves the processed `frames` of source image `im` to `save_filename`, in
+    `format` (by default, the format of the source image), and (for single
+    frames) in each of `formats`, replacing the extension of `save_filename`,
+    with the parameters of encoder `profile`, within byte budget `max_bytes`.
+    """
+    if is_multiframe:
+        duration_ms = im.info.get('duration') or 100
+        duration = float(duration_ms) / 1000.0
+        repeat = True
+        if im.info.get('loop', 0) != 0:
+            repeat = im.info['loop']
+        write_gif(save_filename, frames, duration=duration, repeat=repeat, nq=nq, dispose=dispose)
+    else:
+        _save_frame(im, frames[0], save_filename, (format or im.format or '').upper(),
+            save_params, profile=profile, max_bytes=max_bytes)
+
+    for format in (formats or []):
+        format = format.upper()
+        extension = IMAGE_EXTENSIONS.get(format, '.%s' % format.lower())
+        filename = os.path.splitext(save_filename)[0] + extension
+        _save_frame(im, frames[0], filename, format, profile=profile, max_bytes=max_bytes)
+
+
+def _save_frame(im, frame, save_filename, format, save_params=None, profile=None,
+        max_bytes=None):
+    """Saves `frame`, processed from source image `im`, in `format`."""
+    save_params = dict(get_encoder_params(profile, format), **(save_params or {}))
+    if format != im.format:
+        # Converting, e.g. from PNG to JPEG or WebP
+        save_params['format'] = format
+        if format == 'JPEG':
+            if frame.mode not in ('RGB', 'L', 'CMYK'):
+                frame = frame.convert('RGB')
+        elif frame.mode not in ('RGB', 'RGBA'):
+            frame = frame.convert('RGBA' if is_transparent(frame) else 'RGB')
+    is_lossy = format == 'JPEG' or (format != im.format and format in ('WEBP', 'AVIF'))
+    if is_lossy:
+        save_params.setdefault('quality', get_jpeg_quality(frame.size[0], frame.size[1]))
+    if JPEG_SAVE_ICC_SUPPORTED:
+        if format in ('JPEG', 'PNG'):
+            save_params.setdefault('icc_profile', im.info.get('icc_profile'))
+        elif im.info.get('icc_profile'):
+            save_params.setdefault('icc_profile', im.info['icc_profile'])
+    if is_lossy and max_bytes is not None:
+        if six.callable(max_bytes):
+            max_bytes = max_bytes(frame.size[0], frame.size[1])
+        data = _encode_within_budget(frame, format, max_bytes, save_params)
+        with open(save_filename, mode='wb') as f:
+            f.write(data)
+        return
+    frame.save(save_filename, **save_params)
+
+
+def _encode_within_budget(frame, format, max_bytes, save_params, max_trials=8):
+    """
+    Encodes `frame` in memory at the highest quality, between
+    CROPDUSTER_MIN_JPEG_QUALITY and save_params['quality'], whose output is
+    at most `max_bytes` long, with a binary search of at most `max_trials`
+    encodings. If no quality fits, the smallest encoding is returned.
+    """
+    def encode(quality):
+        buf = io.BytesIO()
+        frame.save(buf, **dict(save_params, format=format, quality=quality))
+        return buf.getvalue()
+
+    hi = save_params['quality']
+    lo = min(CROPDUSTER_MIN_JPEG_QUALITY, hi)
+    best = encode(hi)
+    if len(best) <= max_bytes:
+        return best
+    smallest = best
+    hi -= 1
+    trials = 1
+    best = None
+    while lo <= hi and trials < max_trials:
+        quality = (lo + hi) // 2
+        data = encode(quality)
+        trials += 1
+        if len(data) <= max_bytes:
+            best = data
+            lo = quality + 1
+        else:
+            smallest = data if len(data) < len(smallest) else smallest
+            hi = quality - 1
+    return best or smallest
+
+
+def is_photographic(im, min_colors=None):
+    """
+    Check to see if an image has as many colors as a photograph, as opposed
+    to a flat graphic such as a logo, chart or icon.
+    """
+    if min_colors is None:
+        min_colors = CROPDUSTER_CONVERT_PNG_MIN_COLORS
+    if im.mode in ('1', 'P'):
+        return False
+    # Count the colors of a sample of the pixels; resizing with NEAREST
+    # does not blend in new colors
+    sample = im
+    if im.size[0] * im.size[1] > 256 * 256:
+        sample = im.resize((256, 256), PIL.Image.NEAREST)
+    if sample.mode != 'RGB':
+        sample = sample.convert('RGB')
+    return sample.getcolors(min_colors) is None
+
+
+def is_opaque(im):
+    """
+    Check to see if an image is fully opaque: either it has no transparency
+    or (as with many screenshots) its alpha channel is entirely opaque.
+    """
+    if not is_transparent(im):
+        return True
+    if im.mode in ('RGBA', 'LA'):
+        return im.split()[-1].getextrema() == (255, 255)
+    return False
+
+
+def get_thumb_format(im):
+    """
+    Returns the format thumbnails of image `im` should be saved in, if not
+    the format of `im`. Per the CROPDUSTER_CONVERT_PNG_FORMAT setting,
+    photographic PNGs without transparency can be converted to e.g. JPEG;
+    transparent PNGs and flat graphics are kept as PNGs.
+    """
+    format = CROPDUSTER_CONVERT_PNG_FORMAT
+    if not format or getattr(im, 'format', None) != 'PNG':
+        return None
+    format = format.upper()
+    if format == 'PNG' or not is_format_supported(format):
+        return None
+    if is_animated_gif(im) or not is_opaque(im) or not is_photographic(im):
+        return None
+    return format.lower()
+
+
 def smart_resize(im, final_w, final_h):
     """
     Resizes a given image in multiple steps to ensure maximum quality and performance
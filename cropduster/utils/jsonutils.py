@@ -1,14 +1,24 @@
 import json
+
 from django.utils import six
 from django.utils.six.moves import filter
 
 from cropduster.resizing import Size
+from cropduster.utils.cache import LRUCache
+
+
+__all__ = ('dumps', 'loads', 'loads_sizes')
 
 
-__all__ = ('dumps', 'loads')
+# Maximum number of distinct sizes JSON strings to keep decoded
+INTERNED_SIZES_MAX = 256
+
+_interned_sizes = LRUCache(INTERNED_SIZES_MAX)
 
 
 def json_default(obj):
+    if isinstance(obj, Size):
+        return obj.__serialize__()
     if six.callable(getattr(obj, '__serialize__', None)):
         dct = obj.__serialize__()
         module = obj.__module__
@@ -39,17 +49,62 @@ def object_hook(dct):
             max_h=dct.get('max_h'),
             retina=dct.get('retina'),
             auto=dct.get('auto'),
-            required=dct.get('required'))
+            required=dct.get('required'),
+            widths=dct.get('widths'),
+            formats=dct.get('formats'),
+            profile=dct.get('profile'),
+            max_bytes=dct.get('max_bytes'))
     return dct
 
 
 def dumps(obj, *args, **kwargs):
+    if not args and not kwargs:
+        if isinstance(obj, Size):
+            return _dumps_size(obj)
+        if isinstance(obj, (list, tuple)) and obj and all([isinstance(o, Size) for o in obj]):
+            return u'[%s]' % u', '.join([_dumps_size(sz) for sz in obj])
     kwargs.setdefault('default', json_default)
     return json.dumps(obj, *args, **kwargs)
 
 
+def _dumps_size(size):
+    """Encodes a Size, reusing the encoding of frozen sizes."""
+    if not size.is_frozen:
+        return json.dumps(size.__serialize__())
+    try:
+        return size._json
+    except AttributeError:
+        encoded = json.dumps(size.__serialize__())
+        object.__setattr__(size, '_json', encoded)
+        return encoded
+
+
 def loads(s, *args, **kwargs):
     if isinstance(s, six.binary_type):
         s = s.decode('utf-8')
     kwargs.setdefault('object_hook', object_hook)
     return json.loads(s, *args, **kwargs)
+
+
+def loads_sizes(s):
+    """
+    Decodes JSON containing a Size or a list of Sizes. The most recently
+    decoded strings are kept in a bounded LRU cache, and the Size objects are
+    frozen so they can be shared: repeatedly decoding the same string (for
+    instance, the `sizes` parameter of every request to the crop dialog)
+    returns the same objects rather than building new ones.
+    """
+    if isinstance(s, six.binary_type):
+        s = s.decode('utf-8')
+    sizes = _interned_sizes.get(s, LRUCache.missing)
+    if sizes is LRUCache.missing:
+        sizes = loads(s)
+        if isinstance(sizes, list):
+            sizes = tuple(sizes)
+        for size in (sizes if isinstance(sizes, tuple) else [sizes]):
+            if isinstance(size, Size):
+                size.freeze()
+        _interned_sizes.set(s, sizes)
+    if isinstance(sizes, tuple):
+        return list(sizes)
+    return sizes
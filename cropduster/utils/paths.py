@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import binascii
+import errno
 import os
 import re
 
@@ -7,11 +9,13 @@ from django.conf import settings
 from django.db.models.fields.files import FileField
 from django.utils import six
 
+from cropduster.settings import CROPDUSTER_DEDUPLICATE_DIR
 
-__all__ = ('get_upload_foldername')
 
+__all__ = ('get_upload_foldername', 'get_deduplicated_path', 'deduplicate_file')
 
-MEDIA_ROOT = os.path.abspath(settings.MEDIA_ROOT)
+
+MAX_FOLDERNAME_ATTEMPTS = 10
 
 
 def get_upload_foldername(file_name, upload_to='%Y/%m'):
@@ -27,12 +31,71 @@ def get_upload_foldername(file_name, upload_to='%Y/%m'):
 
     root_dir = os.path.splitext(filename)[0]
     root_dir = dir_name = os.path.join(settings.MEDIA_ROOT, root_dir)
-    i = 1
-    while os.path.exists(dir_name):
+
+    parent_dir = os.path.dirname(root_dir)
+    try:
+        os.makedirs(parent_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # os.mkdir fails if the directory exists, so claiming a folder is atomic.
+    # On a collision, rather than probing name-1, name-2, ... in turn, try
+    # a random suffix, which is all but certain to be free.
+    for i in range(MAX_FOLDERNAME_ATTEMPTS):
+        try:
+            os.mkdir(dir_name)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            return dir_name
+        suffix = binascii.hexlify(os.urandom(3))
         if six.PY2:
-            dir_name = b'%s-%d' % (root_dir, i)
+            dir_name = b'%s-%s' % (root_dir, suffix)
         else:
-            dir_name = '%s-%d' % (root_dir, i)
-        i += 1
-    os.makedirs(dir_name)
-    return dir_name
+            dir_name = '%s-%s' % (root_dir, suffix.decode('ascii'))
+    raise OSError(errno.EEXIST, "Could not allocate an upload folder", root_dir)
+
+
+def get_deduplicated_path(md5, extension):
+    """The path of the file with hash `md5` in the content-addressed store"""
+    return os.path.join(
+        settings.MEDIA_ROOT, CROPDUSTER_DEDUPLICATE_DIR, md5[:2], md5 + extension)
+
+
+def deduplicate_file(path, md5):
+    """
+    Makes the file at `path`, whose contents have hash `md5`, a hard link
+    to the copy of those contents in the content-addressed store, adding
+    it to the store if it is new, so that identical files take up space
+    only once. The store is reference counted by the filesystem: a file
+    in it with a single link is no longer used.
+
+    Returns True if `path` now shares an existing copy. Files are left
+    as they are if the filesystem does not support hard links.
+    """
+    stored_path = get_deduplicated_path(md5, os.path.splitext(path)[1])
+    try:
+        os.makedirs(os.path.dirname(stored_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        os.link(path, stored_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+    else:
+        return False
+    # Atomically replace the new copy with a link to the stored one
+    if six.PY2 and isinstance(path, bytes):
+        tmp_path = b'%s.%s' % (path, md5)
+    else:
+        tmp_path = '%s.%s' % (path, md5)
+    try:
+        os.link(stored_path, tmp_path)
+        os.rename(tmp_path, path)
+    except OSError:
+        return False
+    return True
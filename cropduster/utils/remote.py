@@ -0,0 +1,181 @@
+import hashlib
+import socket
+import tempfile
+import threading
+
+from django.utils.six.moves import http_client, range
+from django.utils.six.moves.urllib import parse as urlparse
+
+from cropduster.exceptions import CropDusterUrlException
+from cropduster.settings import (
+    CROPDUSTER_REMOTE_CONNECT_TIMEOUT, CROPDUSTER_REMOTE_READ_TIMEOUT,
+    CROPDUSTER_REMOTE_MAX_BYTES)
+
+
+__all__ = ('fetch_url', 'ConnectionPool')
+
+
+# Maximum number of idle connections kept open to each host
+MAX_IDLE_CONNECTIONS = 4
+
+MAX_REDIRECTS = 5
+
+# Number of bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class ConnectionPool(object):
+    """
+    Keeps connections to remote hosts open between requests, so that
+    fetching several images from the same server does not pay for a
+    TCP (and TLS) handshake each time.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, port, connect_timeout, read_timeout):
+        """
+        Returns a tuple of a connection to the host and whether it is an
+        idle connection being reused (which the server may have closed).
+        """
+        with self._lock:
+            connections = self._idle.get((scheme, host, port))
+            if connections:
+                return connections.pop(), True
+        if scheme == 'https':
+            conn = http_client.HTTPSConnection(host, port, timeout=connect_timeout)
+        else:
+            conn = http_client.HTTPConnection(host, port, timeout=connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        return conn, False
+
+    def put(self, scheme, host, port, conn):
+        """Return a connection whose response has been read in full."""
+        with self._lock:
+            connections = self._idle.setdefault((scheme, host, port), [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+pool = ConnectionPool()
+
+
+def fetch_url(url, max_bytes=None, connect_timeout=None, read_timeout=None):
+    """
+    Downloads `url`, following redirects, into a temporary file. Returns a
+    tuple of the file (at position 0) and the hex md5 digest of its
+    contents, which is computed as it is written.
+
+    Raises CropDusterUrlException if the URL cannot be fetched, or if the
+    response is larger than `max_bytes` (CROPDUSTER_REMOTE_MAX_BYTES by
+    default), in which case the download stops at that point.
+    """
+    max_bytes = max_bytes or CROPDUSTER_REMOTE_MAX_BYTES
+    connect_timeout = connect_timeout or CROPDUSTER_REMOTE_CONNECT_TIMEOUT
+    read_timeout = read_timeout or CROPDUSTER_REMOTE_READ_TIMEOUT
+
+    for i in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise CropDusterUrlException("Cannot download %s" % url)
+        host_key = (parts.scheme, parts.hostname,
+            parts.port or (443 if parts.scheme == 'https' else 80))
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        conn, response = _request(host_key, path, connect_timeout, read_timeout)
+        try:
+            if response.status in REDIRECT_STATUSES and response.getheader('Location'):
+                _read_response(response, max_bytes)
+                location = response.getheader('Location')
+            elif response.status != 200:
+                raise CropDusterUrlException(
+                    "Could not download %s: HTTP %d" % (url, response.status))
+            else:
+                location = None
+                content_length = response.getheader('Content-Length') or ''
+                if content_length.isdigit() and int(content_length) > max_bytes:
+                    raise CropDusterUrlException(
+                        "Could not download %s: larger than %d bytes" % (url, max_bytes))
+                f = tempfile.TemporaryFile()
+                try:
+                    md5 = _read_response(response, max_bytes, f)
+                except:
+                    f.close()
+                    raise
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            raise CropDusterUrlException("Could not download %s: %s" % (url, e))
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(host_key[0], host_key[1], host_key[2], conn)
+
+        if location is None:
+            f.seek(0)
+            return f, md5.hexdigest()
+        url = urlparse.urljoin(url, location)
+
+    raise CropDusterUrlException("Could not download %s: too many redirects" % url)
+
+
+def _request(host_key, path, connect_timeout, read_timeout):
+    headers = {
+        'Accept': 'image/*',
+        'User-Agent': 'django-cropduster',
+    }
+    while True:
+        try:
+            conn, is_reused = pool.get(*host_key,
+                connect_timeout=connect_timeout, read_timeout=read_timeout)
+        except (http_client.HTTPException, socket.error) as e:
+            raise CropDusterUrlException("Could not connect to %s: %s" % (host_key[1], e))
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            # An idle connection may have been closed by the server; retry
+            # with another (and ultimately a new) connection
+            if not is_reused:
+                raise CropDusterUrlException("Could not download %s: %s" % (path, e))
+
+
+def _read_response(response, max_bytes, f=None):
+    """
+    Reads the body of `response`, writing it to file `f` if given, and
+    returns its md5 hash object. Raises CropDusterUrlException once more
+    than `max_bytes` have been read.
+    """
+    md5 = hashlib.md5()
+    num_bytes = 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        num_bytes += len(chunk)
+        if num_bytes > max_bytes:
+            raise CropDusterUrlException("Response is larger than %d bytes" % max_bytes)
+        md5.update(chunk)
+        if f is not None:
+            f.write(chunk)
+    return md5
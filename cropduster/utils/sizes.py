@@ -15,7 +15,7 @@ def get_min_size(sizes):
     if sizes == 'null':
         return (0, 0)
     if isinstance(sizes, six.string_types):
-        sizes = json.loads(sizes)
+        sizes = json.loads_sizes(sizes)
     if not sizes:
         return (0, 0)
     # The min width and height for the image = the largest w / h of the sizes
@@ -2,11 +2,6 @@ from ..resizing import Crop
 from ..exceptions import CropDusterException
 
 
-class DummyImage(object):
-    def __init__(self, image):
-        self.size = [image.width, image.height]
-
-
 def set_as_auto_crop(thumb, reference_thumb, force=False):
     """
     Sometimes you need to move crop sizes into different crop groups. This
@@ -16,9 +11,9 @@ def set_as_auto_crop(thumb, reference_thumb, force=False):
     This function can be destructive so, by default, it does not re-set the
     parent crop if the new crop box is different than the old crop box.
     """
-    dummy_image = DummyImage(thumb.image)
-    current_best_fit = Crop(thumb.get_crop_box(), dummy_image).best_fit(thumb.width, thumb.height)
-    new_best_fit = Crop(reference_thumb.get_crop_box(), dummy_image).best_fit(thumb.width, thumb.height)
+    original_size = thumb.get_original_size()
+    current_best_fit = Crop(thumb.get_crop_box(), original_size).best_fit(thumb.width, thumb.height)
+    new_best_fit = Crop(reference_thumb.get_crop_box(), original_size).best_fit(thumb.width, thumb.height)
 
     if current_best_fit.box != new_best_fit.box and not force:
         raise CropDusterException("Current image crop based on '%s' is "
@@ -49,7 +44,7 @@ def unset_as_auto_crop(thumb):
         return
 
     reference_thumb_box = thumb.reference_thumb.get_crop_box()
-    crop = Crop(reference_thumb_box, DummyImage(thumb.image))
+    crop = Crop(reference_thumb_box, thumb.get_original_size())
     best_fit = crop.best_fit(thumb.width, thumb.height)
 
     thumb.reference_thumb = None
@@ -28,7 +28,6 @@ from __future__ import division
 
 import os
 import copy
-import shutil
 
 import django
 from django.conf import settings
@@ -52,9 +51,12 @@ from generic_plus.utils import get_relative_media_url
 
 from cropduster.files import ImageFile
 from cropduster.models import Thumb, Size, StandaloneImage, Image
+from cropduster.resizing import Crop
 from cropduster.settings import (
     CROPDUSTER_PREVIEW_WIDTH as PREVIEW_WIDTH,
-    CROPDUSTER_PREVIEW_HEIGHT as PREVIEW_HEIGHT)
+    CROPDUSTER_PREVIEW_HEIGHT as PREVIEW_HEIGHT,
+    CROPDUSTER_CLIENT_SIDE_PREVIEW as CLIENT_SIDE_PREVIEW,
+    CROPDUSTER_PREVIEW_ENCODER_PROFILE as PREVIEW_ENCODER_PROFILE)
 from cropduster.utils import (
     json, is_animated_gif, has_animated_gif_support, process_image)
 from cropduster.exceptions import json_error, CropDusterResizeException, full_exc_info
@@ -118,7 +120,7 @@ class CropDusterIndex(View):
 
     @cached_property
     def sizes(self):
-        return json.loads(self.request.GET.get('sizes', '[]'))
+        return json.loads_sizes(self.request.GET.get('sizes', '[]'))
 
     @cached_property
     def thumbs(self):
@@ -255,7 +257,7 @@ def upload(request):
 
     if not is_standalone:
         preview_file_path = tmp_image.get_image_path('_preview')
-        process_image(img, preview_file_path, fit_preview)
+        process_image(img, preview_file_path, fit_preview, profile=PREVIEW_ENCODER_PROFILE)
 
     data.update({
         'crop': {
@@ -278,10 +280,10 @@ def upload(request):
 
     md5 = form_data.get('md5')
     try:
-        standalone_image = StandaloneImage.objects.get(md5=md5)
+        standalone_image = StandaloneImage.objects.get_by_md5(md5)
     except StandaloneImage.DoesNotExist:
-        standalone_image = StandaloneImage(md5=md5, image=orig_image)
-        standalone_image.save()
+        standalone_image, created = StandaloneImage.objects.get_or_create(
+            md5=md5, defaults={'image': orig_image})
     cropduster_image, created = Image.objects.get_or_create(
         content_type=ContentType.objects.get_for_model(StandaloneImage),
         object_id=standalone_image.pk)
@@ -296,7 +298,7 @@ def upload(request):
     img = PIL.Image.open(cropduster_image.image.path)
     preview_file_path = cropduster_image.get_image_path('_preview')
     if not os.path.exists(preview_file_path):
-        process_image(img, preview_file_path, fit_preview)
+        process_image(img, preview_file_path, fit_preview, profile=PREVIEW_ENCODER_PROFILE)
 
     thumb = cropduster_image.save_size(size, standalone=True)
 
@@ -327,6 +329,32 @@ def upload(request):
     return HttpResponse(json.dumps(data), content_type='application/json')
 
 
+def set_preview_crop_boxes(thumbs_data, thumbs, sizes, original_image):
+    """
+    Add the crop box of each thumb to its entry in `thumbs_data`, so that
+    the crop dialog can draw the thumbnail previews from the preview image.
+    """
+    if not original_image:
+        return
+    size_dict = dict([(sz.name, sz) for sz in Size.flatten(filter(None, sizes))])
+    ref_thumb_ids = [t.pk for t in six.itervalues(thumbs) if not t.reference_thumb_id]
+    auto_thumbs = Thumb.objects.filter(reference_thumb_id__in=ref_thumb_ids)
+    for auto_thumb in auto_thumbs.select_related('reference_thumb'):
+        thumbs.setdefault(auto_thumb.name, auto_thumb)
+    for name, thumb in six.iteritems(thumbs):
+        if name not in size_dict or name not in thumbs_data or not thumb.get_crop_box():
+            continue
+        try:
+            crop_box = thumb.crop(original_image, size_dict[name]).box
+        except CropDusterResizeException:
+            continue
+        thumbs_data[name].update({
+            'crop_box': crop_box.as_tuple(),
+            'width': thumb.width,
+            'height': thumb.height,
+        })
+
+
 @csrf_exempt
 @login_required
 def crop(request):
@@ -358,12 +386,20 @@ def crop(request):
     non_model_fields = set(ThumbForm.declared_fields) - set([f.name for f in Thumb._meta.fields])
 
     # The fields we will pull from when populating the ThumbForm initial data
-    json_thumb_fields = ['id', 'name', 'width', 'height']
+    json_thumb_fields = ['id', 'name', 'width', 'height', 'extension']
 
     thumbs_with_crops = [t for t in cropped_thumbs if t.crop_w and t.crop_h]
     thumbs_data = [f.cleaned_data for f in thumb_formset]
 
     standalone_mode = crop_data['standalone']
+    # server_preview is set when the browser could not draw the previews
+    client_side_preview = (CLIENT_SIDE_PREVIEW and not standalone_mode
+        and not crop_data['server_preview'])
+
+    # Thumbs (keyed on name) for which the browser will draw previews
+    preview_thumbs = {}
+    # (index, size) pairs of new thumbs which have not yet been cropped
+    uncropped = []
 
     for i, (thumb, thumb_form) in enumerate(zip(cropped_thumbs, thumb_formset)):
         changed_fields = set(thumb_form.changed_data) - non_model_fields
@@ -371,7 +407,12 @@ def crop(request):
         thumb_data = thumbs_data[i]
         size = thumb_data['size']
 
-        if changed_fields & set(['crop_x', 'crop_y', 'crop_w', 'crop_h']):
+        # Thumbs staged for client-side previews have no _tmp files, so
+        # they are rendered again if the server is asked for the previews
+        is_staged = bool(thumb.pk and not thumb.image_id)
+
+        if (changed_fields & set(['crop_x', 'crop_y', 'crop_w', 'crop_h'])
+                or (crop_data['server_preview'] and is_staged)):
             # Clear existing primary key to force new thumb creation
             thumb.pk = None
 
@@ -379,7 +420,8 @@ def crop(request):
             thumb.height = min(filter(None, [thumb.height, thumb.crop_h]))
 
             try:
-                new_thumbs = db_image.save_size(size, thumb, tmp=True, standalone=standalone_mode)
+                new_thumbs = db_image.save_size(size, thumb, tmp=True, standalone=standalone_mode,
+                    render=not client_side_preview)
             except CropDusterResizeException as e:
                 return json_error(request, 'crop',
                                   action="saving size", errors=[force_text(e)])
@@ -399,7 +441,7 @@ def crop(request):
 
             thumbs_data[i].update({
                 'changed': True,
-                'url': db_image.get_image_url(thumb.name),
+                'url': db_image.get_image_url(thumb.name, format=thumb.format or None),
             })
 
             for name, new_thumb in six.iteritems(new_thumbs):
@@ -408,32 +450,46 @@ def crop(request):
                 if new_thumb.reference_thumb_id:
                     continue
                 thumbs_data[i]['thumbs'].update({name: thumb_data})
-        elif thumb.pk and thumb.name and thumb.crop_w and thumb.crop_h:
-            thumb_path = db_image.get_image_path(thumb.name, tmp=False)
-            tmp_thumb_path = db_image.get_image_path(thumb.name, tmp=True)
-            if os.path.exists(thumb_path):
-                if not thumb_form.cleaned_data.get('changed') or not os.path.exists(tmp_thumb_path):
-                    shutil.copy(thumb_path, tmp_thumb_path)
+
+            if client_side_preview:
+                preview_thumbs.update(new_thumbs)
+        elif thumb.pk and thumb.image_id:
+            # The thumb (and those referencing it) are unchanged and already
+            # saved, so the browser can show their files in place of _tmp ones
+            for name in set([thumb.name]) | set(thumb_data.get('thumbs') or []):
+                if name in crop_data['thumbs']:
+                    crop_data['thumbs'][name]['tmp_file'] = False
+        elif client_side_preview and thumb.pk:
+            preview_thumbs.setdefault(thumb.name, thumb)
 
         if not thumb.pk and not thumb.crop_w and not thumb.crop_h:
             if not len(thumbs_with_crops):
                 continue
-            best_fit = thumb_form.cleaned_data['size'].fit_to_crop(
-                    thumbs_with_crops[0], original_image=pil_image)
-            if best_fit:
-                thumbs_data[i].update({
-                    'crop_x': best_fit.box.x1,
-                    'crop_y': best_fit.box.y1,
-                    'crop_w': best_fit.box.w,
-                    'crop_h': best_fit.box.h,
-                    'changed': True,
-                    'id': None,
-                })
+            uncropped.append((i, thumb_form.cleaned_data['size']))
+
+    # Fit the thumbs without crops to the first cropped thumb, all at once
+    if uncropped:
+        first_crop = Crop(thumbs_with_crops[0].get_crop_box(), pil_image)
+        best_fits = first_crop.best_fit_many([size for i, size in uncropped])
+        for (i, size), best_fit in zip(uncropped, best_fits):
+            thumbs_data[i].update({
+                'crop_x': best_fit.box.x1,
+                'crop_y': best_fit.box.y1,
+                'crop_w': best_fit.box.w,
+                'crop_h': best_fit.box.h,
+                'changed': True,
+                'id': None,
+            })
 
     for thumb_data in thumbs_data:
         if isinstance(thumb_data['id'], Thumb):
             thumb_data['id'] = thumb_data['id'].pk
 
+    if client_side_preview:
+        crop_data['client_side_preview'] = True
+        set_preview_crop_boxes(crop_data['thumbs'], preview_thumbs,
+            sizes=[d['size'] for d in thumbs_data], original_image=pil_image)
+
     return HttpResponse(json.dumps({
         'crop': crop_data,
         'thumbs': thumbs_data,
@@ -17,8 +17,9 @@ from django.utils.safestring import mark_safe
 from django.utils import six
 
 from cropduster.models import Thumb
+from cropduster.settings import CROPDUSTER_DEDUPLICATE_UPLOADS
 from cropduster.utils import (json, get_upload_foldername, get_min_size,
-    get_image_extension)
+    get_image_extension, deduplicate_file)
 
 
 class ErrorDict(_ErrorDict):
@@ -76,12 +77,14 @@ def clean_upload_data(data):
     # File is good, get rid of the tmp file
     orig_file_path = os.path.join(folder_path, 'original' + extension)
     image.seek(0)
-    image_contents = image.read()
-    with open(os.path.join(settings.MEDIA_ROOT, orig_file_path), 'wb+') as f:
-        f.write(image_contents)
     md5_hash = hashlib.md5()
-    md5_hash.update(image_contents)
+    with open(os.path.join(settings.MEDIA_ROOT, orig_file_path), 'wb+') as f:
+        for chunk in image.chunks():
+            md5_hash.update(chunk)
+            f.write(chunk)
     data['md5'] = md5_hash.hexdigest()
+    if CROPDUSTER_DEDUPLICATE_UPLOADS:
+        deduplicate_file(os.path.join(settings.MEDIA_ROOT, orig_file_path), data['md5'])
     data['image'] = open(os.path.join(settings.MEDIA_ROOT, orig_file_path), mode='rb')
     return data
 
@@ -128,7 +131,7 @@ class UploadForm(FormattedErrorMixin, forms.Form):
     def clean_sizes(self):
         sizes = self.cleaned_data.get('sizes')
         try:
-            return json.loads(sizes)
+            return json.loads_sizes(sizes)
         except:
             return []
 
@@ -146,8 +149,8 @@ class CropForm(forms.Form):
             u"%scropduster/js/jquery.class.js" % settings.STATIC_URL,
             u"%scropduster/js/jquery.form.js?v=1" % settings.STATIC_URL,
             u"%scropduster/js/jquery.jcrop.js?v=5" % settings.STATIC_URL,
-            u"%scropduster/js/cropduster.js?v=8" % settings.STATIC_URL,
-            u"%scropduster/js/upload.js?v=16" % settings.STATIC_URL,
+            u"%scropduster/js/cropduster.js?v=11" % settings.STATIC_URL,
+            u"%scropduster/js/upload.js?v=18" % settings.STATIC_URL,
         )
 
     image_id = forms.IntegerField(required=False)
@@ -157,10 +160,11 @@ class CropForm(forms.Form):
     sizes = forms.CharField()
     thumbs = forms.CharField(required=False)
     standalone = forms.BooleanField(required=False)
+    server_preview = forms.BooleanField(required=False)
 
     def clean_sizes(self):
         try:
-            json.loads(self.cleaned_data.get('sizes', '[]'))
+            json.loads_sizes(self.cleaned_data.get('sizes', '[]'))
         except:
             return []
 
@@ -186,7 +190,7 @@ class ThumbForm(forms.ModelForm):
 
     def clean_size(self):
         try:
-            return json.loads(self.cleaned_data.get('size', 'null'))
+            return json.loads_sizes(self.cleaned_data.get('size', 'null'))
         except:
             return None
 